@@ -0,0 +1,101 @@
+import time
+from collections import deque
+
+from PIL import Image
+
+# Output formats written as animations; other formats get the first frame.
+ANIMATED_FORMATS = ("webp", "gif")
+
+
+def frame_mode(img):
+    # Frames are full composited canvases; alpha is kept only if the source can be transparent.
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        return "RGBA"
+    return "RGB"
+
+
+def source_loop(img):
+    # None for a GIF without a NETSCAPE block, which plays once.
+    if img.format == "GIF" and "loop" not in img.info:
+        return None
+    return img.info.get("loop", 0)
+
+
+class FrameDurations(list):
+    # Pillow's animation writers read duration[i] right after seeking frame i, so durations
+    # are filled in as the frames stream instead of decoding every frame up front to find them.
+    def __init__(self, frames):
+        super().__init__()
+        self.frames = frames
+
+    def __getitem__(self, index):
+        return self.frames.durations[index]
+
+
+class AnimatedFrames(Image.Image):
+    # A multi-frame image whose frames are produced on seek(), which is how save_all pulls
+    # frames from Pillow's own file-backed animations. Frames are decoded in order and
+    # transformed on `pool` up to `lookahead` frames ahead of the encoder, so a long
+    # animation never has more than that many frames in memory.
+    def __init__(self, source, transform, pool, lookahead):
+        super().__init__()
+        self.source = source
+        self.transform = transform
+        self.pool = pool
+        self.lookahead = max(1, lookahead)
+        self.n_frames = source.n_frames
+        self.is_animated = self.n_frames > 1
+        self.frame_mode = frame_mode(source)
+        self.durations = []
+        self.pending = deque()
+        self.decoded = 0
+        self.decode_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.frame = -1
+        self.first = None
+        self.seek(0)
+
+    def decode_ahead(self):
+        while self.decoded < self.n_frames and len(self.pending) < self.lookahead:
+            start = time.perf_counter()
+            self.source.seek(self.decoded)
+            # convert() copies, so the source can move on to the next frame.
+            frame = self.source.convert(self.frame_mode)
+            self.durations.append(self.source.info.get("duration", 0))
+            self.decode_seconds += time.perf_counter() - start
+            self.pending.append(self.pool.submit(self.transform, frame))
+            self.decoded += 1
+
+    def seek(self, frame):
+        if frame == self.frame:
+            return
+        if frame >= self.n_frames:
+            raise EOFError("no more frames")
+        if frame == 0 and self.first is not None:
+            # Writers seek back to the frame they started from once they are done.
+            out = self.first
+        elif frame == self.frame + 1:
+            self.decode_ahead()
+            start = time.perf_counter()
+            out = self.pending.popleft().result()
+            self.wait_seconds += time.perf_counter() - start
+            if frame == 0:
+                self.first = out
+        else:
+            raise ValueError(f"frames stream in order; cannot seek from {self.frame} to {frame}")
+        self.im = out.im
+        self._mode = out.mode
+        self._size = out.size
+        self.info = {"duration": self.durations[frame]}
+        self.frame = frame
+
+    def tell(self):
+        return self.frame
+
+    def close(self):
+        # Frames still in flight when the encoder fails are dropped.
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.first = None
+        super().close()
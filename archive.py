@@ -0,0 +1,224 @@
+import io
+import json
+import mmap
+import os
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+
+ARCHIVE_PREFIX = "sit"
+WRITE_BUFFER = 1 << 20
+ZIP_LOCAL_HEADER = struct.Struct("<26xHH")
+
+_open_sources = {}
+
+
+def open_archive(path):
+    # Worker processes keep one mapping per archive for the whole run.
+    if path not in _open_sources:
+        _open_sources[path] = ArchiveSource(path)
+    return _open_sources[path]
+
+
+class MappedMember(io.RawIOBase):
+    # Read-only file object over a slice of an mmap, so Image.open reads straight from the
+    # page cache without a copy of the whole member.
+    def __init__(self, buffer, start, size):
+        self.buffer = buffer
+        self.start = start
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), self.size - self.pos))
+        b[:n] = self.buffer[self.start + self.pos:self.start + self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+class ArchiveSource:
+    # Members are referenced as ("mapped", offset, size) when stored uncompressed, ("zip",
+    # name) for compressed zip members, and ("bytes", data) for compressed tar streams,
+    # which can only be read in order.
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._zip = None
+        self.lock = threading.Lock()
+
+    def mapping(self):
+        with self.lock:
+            if self._map is None:
+                with open(self.path, "rb") as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map
+
+    def zip_file(self):
+        with self.lock:
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(self.path)
+            return self._zip
+
+    def members(self, extensions):
+        if self.path.lower().endswith(".zip"):
+            yield from self._zip_members(extensions)
+        elif self.path.lower().endswith(".tar"):
+            with tarfile.open(self.path, "r:") as tar:
+                for info in self._tar_infos(tar, extensions):
+                    yield info.name, ("mapped", info.offset_data, info.size)
+        else:
+            with tarfile.open(self.path, "r|*") as tar:
+                for info in self._tar_infos(tar, extensions):
+                    yield info.name, ("bytes", tar.extractfile(info).read())
+
+    def _zip_members(self, extensions):
+        buffer = self.mapping()
+        for info in self.zip_file().infolist():
+            if info.is_dir() or not info.filename.lower().endswith(extensions):
+                continue
+            if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+                name_length, extra_length = ZIP_LOCAL_HEADER.unpack_from(
+                    buffer, info.header_offset)
+                offset = info.header_offset + zipfile.sizeFileHeader + \
+                    name_length + extra_length
+                yield info.filename, ("mapped", offset, info.file_size)
+            else:
+                yield info.filename, ("zip", info.filename)
+
+    @staticmethod
+    def _tar_infos(tar, extensions):
+        while True:
+            info = tar.next()
+            if info is None:
+                return
+            # Members are never revisited; dropping them keeps memory flat on huge archives.
+            tar.members.clear()
+            if info.isfile() and not info.issparse() and info.name.lower().endswith(extensions):
+                yield info
+
+    def read_member(self, file_path, output_dir_for_file, ref):
+        # Runs in the pipeline's reader threads, so compressed zip members are inflated in
+        # parallel; mapped members are passed on untouched.
+        if ref[0] == "zip":
+            with self.zip_file().open(ref[1]) as f:
+                ref = ("bytes", f.read())
+        return file_path, output_dir_for_file, ref
+
+    def open_member(self, ref):
+        # Called after read_member, so only mapped and in-memory members arrive here.
+        if ref[0] == "mapped":
+            return MappedMember(self.mapping(), ref[1], ref[2])
+        return io.BytesIO(ref[1])
+
+    @staticmethod
+    def member_size(ref):
+        return ref[2] if ref[0] == "mapped" else len(ref[1])
+
+    def iter_jobs(self, output_dir, extensions):
+        for name, ref in self.members(extensions):
+            # Output keeps the member's directory inside the archive; absolute paths and ".."
+            # components are dropped so nothing is written outside output_dir.
+            parts = [part for part in name.replace("\\", "/").split("/")
+                     if part not in ("", ".", "..")]
+            if not parts:
+                continue
+            yield (os.path.join(self.path, *parts),
+                   os.path.normpath(os.path.join(output_dir, *parts[:-1])), ref)
+
+    def close(self):
+        with self.lock:
+            if self._zip is not None:
+                self._zip.close()
+            if self._map is not None:
+                self._map.close()
+            self._zip = self._map = None
+
+
+class ArchiveWriter:
+    # Streams outputs into numbered tar or stored-zip shards with one sequential write per
+    # shard. Each shard gets a sidecar <shard>.index.jsonl with the byte offset and size of
+    # every member, so single outputs can be fetched with ranged reads.
+    def __init__(self, output_dir, archive_format="tar", max_bytes=1 << 30):
+        self.output_dir = output_dir
+        self.archive_format = archive_format
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.shard = -1
+        self.shards = []
+        self.members = 0
+        self._file = None
+        self._archive = None
+        self._index = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _open_shard(self):
+        self._close_shard()
+        self.shard += 1
+        name = f"{ARCHIVE_PREFIX}-{self.shard:05d}.{self.archive_format}"
+        path = os.path.join(self.output_dir, name)
+        self._file = open(path, "wb", buffering=WRITE_BUFFER)
+        if self.archive_format == "zip":
+            self._archive = zipfile.ZipFile(self._file, "w", zipfile.ZIP_STORED)
+        else:
+            self._archive = tarfile.open(fileobj=self._file, mode="w")
+        self._index = open(path + ".index.jsonl", "w", encoding="utf-8")
+        self.shards.append(path)
+
+    def _close_shard(self):
+        if self._archive is None:
+            return
+        self._archive.close()
+        self._file.close()
+        self._index.close()
+        self._archive = self._file = self._index = None
+
+    def add(self, name, data):
+        with self.lock:
+            # Roll over before a member would push a non-empty shard past the limit.
+            if self._archive is None or (self._file.tell() > 0 and self._file.tell() + len(data) > self.max_bytes):
+                self._open_shard()
+            if self.archive_format == "zip":
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                self._archive.writestr(info, data)
+                offset = info.header_offset + zipfile.sizeFileHeader + \
+                    len(info.filename.encode("utf-8")) + len(info.extra)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                info.mode = 0o644
+                self._archive.addfile(info, io.BytesIO(data))
+                offset = self._file.tell() - tarfile.BLOCKSIZE * \
+                    -(-len(data) // tarfile.BLOCKSIZE)
+                # Written members are never read back; dropping them keeps memory flat.
+                self._archive.members.clear()
+            self._index.write(json.dumps(
+                {"name": name, "offset": offset, "size": len(data)}) + "\n")
+            self.members += 1
+            return f"{self.shards[-1]}:{name}"
+
+    def close(self):
+        with self.lock:
+            self._close_shard()
+
+    def summary(self):
+        return f"Archive: {self.members} outputs in {len(self.shards)} {self.archive_format} shard(s)"
@@ -0,0 +1,341 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+CORPUS_VERSION = 1
+DEFAULT_CORPUS_DIR = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), ".corpus")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "baseline.json")
+
+# (width, height, mode, format) per corpus image; the full corpus repeats this list with
+# different seeds.
+CORPUS_SHAPES = [
+    (6000, 4000, "RGB", "jpeg"),
+    (4000, 6000, "RGB", "jpeg"),
+    (3000, 3000, "RGB", "jpeg"),
+    (1920, 1080, "RGB", "jpeg"),
+    (2400, 1600, "RGBA", "png"),
+    (1200, 1200, "L", "png"),
+    (1024, 768, "P", "png"),
+    (3000, 2000, "RGB", "webp"),
+    (1600, 1600, "RGBA", "webp"),
+    (800, 600, "RGB", "webp"),
+]
+
+OPTION_MATRIX = {
+    "workers": sorted({1, os.cpu_count() or 1}),
+    "shrink_on_load": [True, False],
+    "streaming": [False, True],
+}
+
+
+def synthetic_image(rng, width, height, mode):
+    img = Image.linear_gradient("L").resize((width, height))
+    img = Image.merge("RGB", (img, img.rotate(90).resize((width, height)),
+                              Image.effect_mandelbrot((width, height), (-2.0, -1.5, 1.0, 1.5), 64)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 4 + 1), y0 + \
+            rng.randrange(height // 4 + 1)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+    # A band of noise keeps the encoders honest about high-frequency content.
+    noise_height = max(1, height // 8)
+    noise = Image.frombytes("RGB", (width, noise_height),
+                            rng.randbytes(width * noise_height * 3))
+    img.paste(noise, (0, height - noise_height))
+    if mode == "RGBA":
+        alpha = Image.radial_gradient("L").resize((width, height))
+        img.putalpha(alpha)
+    elif mode == "L":
+        img = img.convert("L")
+    elif mode == "P":
+        img = img.quantize(colors=64)
+    return img
+
+
+def generate_corpus(corpus_dir, count, seed=1234):
+    marker = os.path.join(corpus_dir, "corpus.json")
+    spec = {"version": CORPUS_VERSION, "count": count, "seed": seed}
+    if os.path.exists(marker):
+        with open(marker, "r", encoding="utf-8") as f:
+            if json.load(f) == spec:
+                return corpus_dir
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    os.makedirs(corpus_dir)
+    for i in range(count):
+        width, height, mode, fmt = CORPUS_SHAPES[i % len(CORPUS_SHAPES)]
+        rng = random.Random(seed + i)
+        img = synthetic_image(rng, width, height, mode)
+        subdir = os.path.join(corpus_dir, fmt)
+        os.makedirs(subdir, exist_ok=True)
+        ext = "jpg" if fmt == "jpeg" else fmt
+        path = os.path.join(subdir, f"img{i:03d}_{width}x{height}_{mode}.{ext}")
+        save_kwargs = {"quality": 90} if fmt in ("jpeg", "webp") else {}
+        img.save(path, fmt.upper(), **save_kwargs)
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump(spec, f)
+    return corpus_dir
+
+
+def preset_kwargs(preset):
+    from cli import PRESETS
+    settings = PRESETS[preset]["settings"]
+    kwargs = {}
+    if "size" in settings:
+        kwargs["size"] = tuple(int(v)
+                               for v in settings["size"].lower().split("x"))
+    if "aspect" in settings:
+        kwargs["aspect_ratio"] = settings["aspect"]
+        kwargs["crop_position"] = "center"
+    if "format" in settings:
+        kwargs["output_format"] = settings["format"]
+    if "quality" in settings:
+        kwargs["quality"] = settings["quality"]
+    if "dpi" in settings:
+        kwargs["dpi"] = settings["dpi"]
+    if "speed" in settings:
+        kwargs["speed"] = settings["speed"]
+    return kwargs
+
+
+def build_configs(presets, speeds=None):
+    configs = []
+    keys = list(OPTION_MATRIX)
+    for preset in presets:
+        for speed in speeds or [None]:
+            for values in itertools.product(*(OPTION_MATRIX[k] for k in keys)):
+                options = dict(zip(keys, values))
+                name = f"preset={preset}," + \
+                    ",".join(f"{k}={v}" for k, v in options.items())
+                if speed:
+                    # Overrides the preset's own speed; only named when chosen explicitly so
+                    # existing baselines keep matching.
+                    options["speed"] = speed
+                    name += f",speed={speed}"
+                configs.append({"name": name, "preset": preset, "options": options})
+    return configs
+
+
+class PeakRssSampler:
+    # Worker processes are started through a fork server, so they are not our direct
+    # children and RUSAGE_CHILDREN never sees them. On Linux the whole process tree is
+    # sampled from /proc instead; elsewhere this falls back to getrusage.
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(
+            os, "sysconf") else 4096
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _tree_rss(self):
+        parents = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat", "rb") as f:
+                    stat = f.read()
+                parents[int(entry)] = int(stat.rsplit(b")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+        tree = {os.getpid()}
+        changed = True
+        while changed:
+            changed = False
+            for pid, ppid in parents.items():
+                if ppid in tree and pid not in tree:
+                    tree.add(pid)
+                    changed = True
+        total = 0
+        for pid in tree:
+            try:
+                with open(f"/proc/{pid}/statm", "rb") as f:
+                    total += int(f.read().split()[1]) * self.page_size
+            except (OSError, IndexError, ValueError):
+                continue
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._tree_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if os.path.isdir("/proc"):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def peak_mb(self):
+        if self.peak:
+            return self.peak / (1024 * 1024)
+        if resource is None:
+            return None
+        usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+def run_child(config, corpus_dir):
+    from image_optimizer import ImageOptimizer
+    megapixels = 0.0
+    images = 0
+    for root, dirs, files in os.walk(corpus_dir):
+        for name in files:
+            if name.endswith((".jpg", ".png", ".webp")):
+                with Image.open(os.path.join(root, name)) as img:
+                    megapixels += img.width * img.height / 1e6
+                images += 1
+    output_dir = tempfile.mkdtemp(prefix="sit-bench-")
+    try:
+        optimizer = ImageOptimizer(corpus_dir, output_dir,
+                                   **{**preset_kwargs(config["preset"]), **config["options"]})
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull), PeakRssSampler() as sampler:
+            start = time.perf_counter()
+            optimizer.process_directory()
+            elapsed = time.perf_counter() - start
+        output_bytes = sum(os.path.getsize(os.path.join(root, name))
+                           for root, dirs, files in os.walk(output_dir) for name in files)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {
+        "name": config["name"],
+        "images": images,
+        "megapixels": round(megapixels, 3),
+        "seconds": round(elapsed, 4),
+        "images_per_sec": round(images / elapsed, 3),
+        "megapixels_per_sec": round(megapixels / elapsed, 3),
+        "peak_rss_mb": None if sampler.peak_mb() is None else round(sampler.peak_mb(), 1),
+        "output_bytes": output_bytes,
+    }
+
+
+def run_config(config, corpus_dir, repeat):
+    # Every configuration runs in a fresh interpreter so peak RSS is not inherited from the
+    # previous one; the best of `repeat` runs is kept.
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(config),
+                              "--corpus-dir", corpus_dir], capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    previous = {r["name"]: r for r in baseline.get("results", [])}
+    for result in results:
+        base = previous.get(result["name"])
+        if base is None:
+            continue
+        if result["images_per_sec"] < base["images_per_sec"] * (1 - threshold):
+            regressions.append(
+                f"{result['name']}: images/sec {base['images_per_sec']} -> {result['images_per_sec']}")
+        if result["output_bytes"] > base["output_bytes"] * (1 + threshold):
+            regressions.append(
+                f"{result['name']}: output bytes {base['output_bytes']} -> {result['output_bytes']}")
+    return regressions
+
+
+def main():
+    from cli import PRESETS
+    parser = argparse.ArgumentParser(
+        description="Reproducible benchmark suite for the SiT image pipeline.")
+    parser.add_argument("--presets", type=str, default=",".join(PRESETS),
+                        help="Comma-separated presets to run (default: all)")
+    parser.add_argument("--speeds", type=str,
+                        help="Comma-separated --speed profiles to compare (default: each preset's own)")
+    parser.add_argument("--images", type=int, default=len(CORPUS_SHAPES) * 2,
+                        help="Number of synthetic corpus images")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs per configuration; the fastest is reported")
+    parser.add_argument("--corpus-dir", type=str, default=DEFAULT_CORPUS_DIR,
+                        help="Where the synthetic corpus is generated")
+    parser.add_argument("--output", type=str,
+                        help="Write results JSON to this file")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE,
+                        help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Allowed regression before failing (default 0.10 = 10%%)")
+    parser.add_argument("--child", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child), args.corpus_dir)))
+        return 0
+
+    corpus_dir = generate_corpus(args.corpus_dir, args.images)
+    report = {
+        # The corpus is identified by its generator spec rather than its bytes, so a baseline
+        # stays comparable across Pillow upgrades that change encoder output.
+        "corpus": {"version": CORPUS_VERSION, "images": args.images},
+        "environment": {"python": sys.version.split()[0], "pillow": Image.__version__,
+                        "cpu_count": os.cpu_count()},
+        "results": [],
+    }
+    speeds = [s.strip() for s in args.speeds.split(",") if s.strip()] if args.speeds else None
+    for config in build_configs([p.strip() for p in args.presets.split(",") if p.strip()], speeds):
+        result = run_config(config, corpus_dir, args.repeat)
+        report["results"].append(result)
+        print(f"{result['name']}: {result['images_per_sec']} img/s, {result['megapixels_per_sec']} MP/s, "
+              f"peak RSS {result['peak_rss_mb']} MB, {result['output_bytes']} bytes", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    status = 0
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("corpus") != report["corpus"]:
+            print("Baseline was recorded on a different corpus; skipping comparison.",
+                  file=sys.stderr)
+        else:
+            regressions = compare(report["results"], baseline, args.threshold)
+            for line in regressions:
+                print(f"REGRESSION {line}", file=sys.stderr)
+            status = 1 if regressions else 0
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(ROOT, "cli.py")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "startup_baseline.json")
+
+# Single-file jobs as a pipeline would issue them, one interpreter per call.
+MODES = {
+    "interactive": [],
+    "headless": ["--headless"],
+}
+
+
+def make_image(path):
+    from PIL import Image
+    Image.effect_mandelbrot((640, 480), (-2.0, -1.5, 1.0, 1.5), 64).convert(
+        "RGB").save(path, "JPEG", quality=85)
+
+
+def time_calls(mode, image, output_dir, runs):
+    # Runs in a scratch cwd so the interactive mode's config.json write is measured but not
+    # left in the repo.
+    command = [sys.executable, CLI, *MODES[mode], "-i", image, "-o", output_dir,
+               "-s", "320x240", "-f", "webp", "--quality", "80"]
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=os.path.dirname(image), stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        samples.append((time.perf_counter() - start) * 1000)
+        config_path = os.path.join(os.path.dirname(image), "config.json")
+        if os.path.exists(config_path):
+            os.remove(config_path)
+    samples.sort()
+    return {"mode": mode, "runs": runs, "median_ms": round(statistics.median(samples), 1),
+            "p90_ms": round(samples[int(0.9 * (runs - 1))], 1), "min_ms": round(samples[0], 1)}
+
+
+def import_profile(image, output_dir, top):
+    # Cumulative import time per top-level module of one headless call (python -X importtime).
+    out = subprocess.run([sys.executable, "-X", "importtime", CLI, "--headless", "-i", image,
+                          "-o", output_dir, "-s", "320x240", "-f", "webp"],
+                         cwd=os.path.dirname(image), capture_output=True, text=True, check=True)
+    modules = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return [{"module": name, "ms": round(ms, 1)} for ms, name in sorted(modules, reverse=True)[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Startup time of single-file cli.py calls, interactive vs --headless.")
+    parser.add_argument("--runs", type=int, default=20,
+                        help="Calls per mode (default 20)")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Slowest top-level imports to list for --headless (default 10)")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE,
+                        help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.20,
+                        help="Allowed regression of the headless median before failing (default 0.20 = 20%%)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        image = os.path.join(scratch, "input.jpg")
+        make_image(image)
+        output_dir = os.path.join(scratch, "out")
+        results = [time_calls(mode, image, output_dir, args.runs) for mode in MODES]
+        imports = import_profile(image, output_dir, args.top)
+    report = {"environment": {"python": sys.version.split()[0]},
+              "results": results, "headless_imports": imports}
+    for result in results:
+        print(f"{result['mode']}: median {result['median_ms']} ms, p90 {result['p90_ms']} ms, "
+              f"min {result['min_ms']} ms", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    base = {r["mode"]: r for r in baseline.get("results", [])}.get("headless")
+    current = next(r for r in results if r["mode"] == "headless")
+    if base and current["median_ms"] > base["median_ms"] * (1 + args.threshold):
+        print(f"REGRESSION headless: median {base['median_ms']} ms -> {current['median_ms']} ms",
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,30 @@
 import argparse
+import cProfile
 import os
 import json
 import sys
 import shutil
 from datetime import datetime
-from image_optimizer import ImageOptimizer
-from rich.console import Console
-from rich.prompt import Prompt, IntPrompt, Confirm
-from rich.panel import Panel
+from pipeline import ARCHIVE_EXTENSIONS
+from image_optimizer import ImageOptimizer, load_plugins
 
 __version__ = "0.0.3"
-console = Console()
+
+
+class LazyConsole:
+    # rich is imported on the first print, so runs that never print through it (--headless)
+    # do not pay for the import.
+    def __init__(self):
+        self._console = None
+
+    def __getattr__(self, name):
+        if self._console is None:
+            from rich.console import Console
+            self._console = Console()
+        return getattr(self._console, name)
+
+
+console = LazyConsole()
 
 LOGO = r"""
  ░▒▓███████▓▒░ ░▒▓█▓▒░░▒▓█▓▒░ ░▒▓█▓▒░ ░▒▓███████▓▒░   ░▒▓██████▓▒░  ░▒▓███████▓▒░  ░▒▓█▓▒░
@@ -29,15 +43,16 @@ PRESETS = {
     "social": {"description": "Optimized for social media (1080x1080, 1:1, quality 90, jpg).", "settings": {"size": "1080x1080", "aspect": "1:1", "quality": 90, "format": "jpg"}},
     "print": {"description": "Optimized for print (3000x3000, 1:1, quality 100, dpi 300, tiff).", "settings": {"size": "3000x3000", "aspect": "1:1", "quality": 100, "dpi": 300, "format": "tiff"}},
     "web": {"description": "Optimized for web (1920x1080, 16:9, quality 80, webp).", "settings": {"size": "1920x1080", "aspect": "16:9", "quality": 80, "format": "webp"}},
-    "fast": {"description": "Faster processing with lower quality (quality 70).", "settings": {"quality": 70}}
+    "fast": {"description": "Faster processing with lower quality (quality 70, speed fastest).", "settings": {"quality": 70, "speed": "fastest"}}
 }
 
 
 def print_logo():
+    from rich.panel import Panel
     console.print(Panel(LOGO, style="bold magenta", expand=False))
 
 
-def load_config(config_path="config.json"):
+def load_config(config_path="config.json", save_default=True):
     default_config = {
         "default_input_dir": "input",
         "default_output_dir": "output",
@@ -49,7 +64,8 @@ def load_config(config_path="config.json"):
         "default_dpi": None,
         "default_keep_metadata": False,
         "default_timestamp": "datetime",
-        "default_group_by_format": False
+        "default_group_by_format": False,
+        "default_workers": 1
     }
     config = {}
     if os.path.exists(config_path):
@@ -60,8 +76,9 @@ def load_config(config_path="config.json"):
             console.print(f"[red]Error loading config file: {e}[/red]")
     else:
         config = default_config
-        with open(config_path, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=2)
+        if save_default:
+            with open(config_path, "w", encoding="utf-8") as f:
+                json.dump(config, f, indent=2)
     for key, value in default_config.items():
         if key not in config:
             config[key] = value
@@ -114,6 +131,59 @@ def parse_size(size_str):
         return None
 
 
+def parse_renditions(value):
+    renditions = []
+    try:
+        for spec in value.split(","):
+            parts = [p.strip() for p in spec.strip().split(":")]
+            if len(parts) > 3 or not parts[0]:
+                raise ValueError(f"'{spec}' must be SIZE[:FORMAT[:QUALITY]]")
+            rendition = {"size": None, "max_size": None}
+            if "x" in parts[0].lower():
+                rendition["size"] = parse_size(parts[0])
+                if rendition["size"] is None:
+                    return None
+            else:
+                edge = int(parts[0])
+                if edge <= 0 or edge > 4080:
+                    raise ValueError("Dimensions must not exceed 4080px.")
+                rendition["max_size"] = (edge, edge)
+            if len(parts) > 1 and parts[1]:
+                is_valid, error_message, fmt = validate_format(parts[1])
+                if not is_valid:
+                    raise ValueError(error_message)
+                rendition["format"] = fmt
+            if len(parts) > 2 and parts[2]:
+                is_valid, error_message, quality = validate_int_range(
+                    parts[2], 0, 100)
+                if not is_valid:
+                    raise ValueError(error_message)
+                rendition["quality"] = quality
+            renditions.append(rendition)
+        return renditions
+    except Exception as e:
+        console.print(f"[red]Invalid renditions '{value}': {e}[/red]")
+        return None
+
+
+def parse_byte_size(value):
+    units = {"": 1, "b": 1, "kb": 1000, "mb": 1000 ** 2, "gb": 1000 ** 3,
+             "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3}
+    try:
+        text = value.strip().lower()
+        number = text.rstrip("kmgib")
+        unit = text[len(number):]
+        if unit not in units:
+            raise ValueError(f"unknown unit '{unit}'")
+        size = int(float(number) * units[unit])
+        if size <= 0:
+            raise ValueError("size must be positive")
+        return size
+    except Exception as e:
+        console.print(f"[red]Invalid byte size '{value}': {e}[/red]")
+        return None
+
+
 def validate_size(value):
     parsed = parse_size(value)
     if parsed is not None:
@@ -331,20 +401,20 @@ def summary_confirmation(responses):
 
 
 def main():
-    print_logo()
-    config = load_config()
     parser = argparse.ArgumentParser(
         description="Shinobi Image Tool (SiT) - Batch image processor with presets and guide-mode.")
     parser.add_argument("--guide-mode", action="store_true",
                         help="Run interactive guide-mode (no flags required)")
     parser.add_argument("--preset", type=str, default="default", choices=list(
         PRESETS.keys()), help="Select a preset (default, social, print, web, fast)")
-    parser.add_argument("-i", "--input", type=str, help="Input directory")
+    parser.add_argument("-i", "--input", type=str, help="Input directory (or a single image file)")
     parser.add_argument("-o", "--output", type=str, help="Output directory")
     parser.add_argument("-s", "--size", type=str,
                         help="Target size (e.g., 1080x1080)")
     parser.add_argument("-a", "--aspect", type=str,
                         help="Aspect ratio (e.g., 16:9)")
+    parser.add_argument("--crop", type=str,
+                        help="Crop to --aspect anchored at this position (center, top, bottom, left, right)")
     parser.add_argument("-f", "--format", type=str,
                         help="Output format (webp, jpg, png). For multiple formats separate with commas")
     parser.add_argument("-p", "--crop_pixels", type=str,
@@ -357,9 +427,82 @@ def main():
                         help="Preserve image metadata (EXIF)")
     parser.add_argument("-m", "--max_size", type=str,
                         help="Max size (e.g., 1920x1080)")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="Number of worker processes (e.g., 8). Defaults to 1")
+    parser.add_argument("--renditions", type=str,
+                        help="Produce several sizes from one decode, e.g. 2048,1080:webp:80,512x512,256 (SIZE[:FORMAT[:QUALITY]]; a single number fits within NxN)")
+    parser.add_argument("--rendition-layout", type=str, choices=["dirs", "suffix"], default="dirs",
+                        help="Write renditions to per-size subdirectories (dirs) or with a per-size filename suffix (suffix)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream the input tree through overlapped read/transform/write stages with bounded memory")
+    parser.add_argument("--io-threads", type=int, default=4,
+                        help="Reader and writer threads per stage in --stream mode (default 4)")
+    parser.add_argument("--target-size", type=str,
+                        help="Byte budget per jpg/webp output (e.g., 150KB); picks the highest quality that fits")
+    parser.add_argument("--speed", type=str, choices=["fastest", "balanced", "smallest"],
+                        help="Encoder/resampler effort: fastest, balanced (default) or smallest output")
+    parser.add_argument("--passthrough", type=str, choices=["copy", "link"],
+                        help="Copy (or hardlink) files that already match the output format and size instead of re-encoding them")
+    parser.add_argument("--dedup", type=str, choices=["bytes", "pixels"],
+                        help="Render identical sources once and hardlink the outputs of the copies (bytes: identical files; pixels: also files that only differ in metadata)")
+    parser.add_argument("--dedup-copy", action="store_true",
+                        help="With --dedup, copy duplicate outputs instead of hardlinking them")
+    parser.add_argument("--archive", type=str, choices=["tar", "zip"],
+                        help="Stream outputs into sharded tar or stored-zip archives with a sidecar index instead of individual files")
+    parser.add_argument("--archive-size", type=str, default="1GiB",
+                        help="Start a new archive shard at this size (default 1GiB)")
+    parser.add_argument("--max-memory", type=str,
+                        help="Memory budget for parallel runs (e.g., 4GB); images above it are processed one at a time")
+    parser.add_argument("--metrics", type=str,
+                        help="Write run metrics at the end of the run (.prom for a Prometheus textfile, otherwise JSON)")
+    parser.add_argument("--event-log", type=str,
+                        help="Write the JSON-lines event log to this file instead of stdout")
+    parser.add_argument("--event-rate", type=int, default=50,
+                        help="Maximum non-error events logged per second (0 = unlimited, default 50)")
+    parser.add_argument("--profile", type=str,
+                        help="Write cProfile statistics of the run to this file")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip images whose source and settings are unchanged since the last run")
+    parser.add_argument("--content-hash", action="store_true",
+                        help="With --incremental, compare file contents when the modification time changed")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and process new or modified files in the input directory as they arrive")
+    parser.add_argument("--watch-settle", type=float, default=0.5,
+                        help="Seconds a file must stay unchanged before it is processed in --watch mode (default 0.5)")
+    parser.add_argument("--watch-poll", type=float,
+                        help="Poll the input tree every N seconds instead of using inotify in --watch mode")
+    parser.add_argument("--plan", action="store_true",
+                        help="Dry run: scan headers, encode a small sample and predict output size and run time without writing outputs")
+    parser.add_argument("--plan-sample", type=int, default=24,
+                        help="Files encoded by --plan to calibrate its predictions (default 24)")
+    parser.add_argument("--plan-json", type=str,
+                        help="Also write the --plan report as JSON to this file")
+    parser.add_argument("--shard", type=str, metavar="K/N",
+                        help="Process only shard K of N (1-based) of the input tree; run one shard per node with the same input and settings")
+    parser.add_argument("--shard-balance", type=str, choices=["hash", "size"], default="hash",
+                        help="Assign files to shards by path hash (default) or balance total bytes per shard (every node stats the whole tree)")
+    parser.add_argument("--merge-shards", type=str, nargs="*", metavar="DIR",
+                        help="Check the shard manifests in these directories (default: the output directory) against the input tree, report missing files and unfinished shards, and write a merged manifest")
+    parser.add_argument("--serve", type=str, metavar="[HOST:]PORT",
+                        help="Serve resized renditions of the input directory over HTTP at /img/<path>?w=&h=&fmt=&q=")
+    parser.add_argument("--cache-dir", type=str,
+                        help="With --serve, keep rendered images in this directory across restarts")
+    parser.add_argument("--cache-memory", type=str, default="256MiB",
+                        help="With --serve, bytes of rendered images kept in memory (default 256MiB)")
+    parser.add_argument("--cache-disk", type=str, default="2GiB",
+                        help="With --serve, bytes of rendered images kept in --cache-dir (default 2GiB)")
+    parser.add_argument("--headless", action="store_true",
+                        help="For scripted runs: no banner, progress bar, prompts or config.json creation, and only the needed modules and Pillow plugins are loaded")
     parser.add_argument("-v", "--version", action="version",
                         version=f"SiT v{__version__}")
     args = parser.parse_args()
+    headless = args.headless
+    if headless and args.guide_mode:
+        print("--headless cannot be combined with --guide-mode.", file=sys.stderr)
+        sys.exit(1)
+    if not headless:
+        print_logo()
+    config = load_config(save_default=not headless)
     if args.guide_mode:
         responses = guide_mode(config)
         summary_confirmation(responses)
@@ -379,13 +522,110 @@ def main():
         "keep_metadata") is not None else config.get("default_keep_metadata")
     delete_originals = args_dict.get("delete_originals") if args_dict.get(
         "delete_originals") is not None else False
-    parsed_size = parse_size(size_str)
-    while parsed_size is None:
+    workers = args_dict.get("workers") or config.get("default_workers") or 1
+    if args_dict.get("serve"):
+        host, _, port = args_dict["serve"].rpartition(":")
+        memory_bytes = parse_byte_size(args_dict.get("cache_memory") or "256MiB")
+        disk_bytes = parse_byte_size(args_dict.get("cache_disk") or "2GiB")
+        if not port.isdigit() or memory_bytes is None or disk_bytes is None:
+            console.print("[red]--serve expects [HOST:]PORT, e.g. 8080 or 0.0.0.0:8080.[/red]")
+            sys.exit(1)
+        if not input_dir or not os.path.isdir(input_dir):
+            console.print(f"[red]--serve needs an input directory, got {input_dir}.[/red]")
+            sys.exit(1)
+        # Per-request geometry, format and quality come from the URL; the rest from the CLI.
+        settings = {"dpi": dpi, "keep_metadata": keep_metadata,
+                    "speed": args_dict.get("speed") or "balanced"}
+        from server import serve
+        serve((host or "127.0.0.1", int(port)), input_dir, cache_dir=args_dict.get("cache_dir"),
+              memory_bytes=memory_bytes, disk_bytes=disk_bytes, settings=settings,
+              max_renders=args_dict.get("workers"))
+        return
+    if args_dict.get("merge_shards") is not None:
+        from image_optimizer import IMAGE_EXTENSIONS
+        from shard import merge_shards, print_merge_report
+        directories = args_dict["merge_shards"] or [output_dir]
+        if not input_dir or not os.path.isdir(input_dir) or not all(directories):
+            console.print("[red]--merge-shards needs the input directory and the shard output directories.[/red]")
+            sys.exit(1)
+        report = merge_shards(input_dir, directories, IMAGE_EXTENSIONS)
+        if report is None:
+            console.print(f"[red]No shard manifests found in {', '.join(directories)}.[/red]")
+            sys.exit(1)
+        print_merge_report(report)
+        sys.exit(0 if report["complete"] else 1)
+    shard = None
+    if args_dict.get("shard"):
+        from shard import Shard, parse_shard
+        parsed_shard = parse_shard(args_dict["shard"])
+        if parsed_shard is None:
+            console.print("[red]--shard expects K/N with 1 <= K <= N, e.g. 3/8.[/red]")
+            sys.exit(1)
+        if args_dict.get("watch") or args_dict.get("archive") or (
+                input_dir and input_dir.lower().endswith(ARCHIVE_EXTENSIONS)):
+            console.print("[red]--shard cannot be combined with --watch or archive inputs and outputs.[/red]")
+            sys.exit(1)
+        shard = Shard(*parsed_shard, args_dict.get("shard_balance") or "hash")
+    if headless:
+        # No prompts: a missing size means no resize, an invalid one is an error.
+        parsed_size = parse_size(size_str) if size_str else None
+        if size_str and parsed_size is None:
+            sys.exit(1)
+    else:
+        parsed_size = parse_size(size_str)
+    while parsed_size is None and not headless:
         console.print(
             "[red]Please enter a valid size (e.g., 1080x1080) that does not exceed 4080px.[/red]")
+        from rich.prompt import Prompt
         size_str = Prompt.ask(
             "Enter new size", default=config.get("default_size"))
         parsed_size = parse_size(size_str)
+    crop_position = args_dict.get("crop")
+    if crop_position:
+        valid, message, crop_position = validate_crop_position(crop_position)
+        if not valid:
+            console.print(f"[red]{message}[/red]")
+            sys.exit(1)
+    max_size = args_dict.get("max_size")
+    if isinstance(max_size, str):
+        max_size = parse_size(max_size)
+        if max_size is None:
+            sys.exit(1)
+    crop_pixels = args_dict.get("crop_pixels")
+    if isinstance(crop_pixels, str):
+        valid, message, crop_pixels = validate_crop_pixels(crop_pixels)
+        if not valid:
+            console.print(f"[red]{message}[/red]")
+            sys.exit(1)
+    renditions = None
+    if args_dict.get("renditions"):
+        renditions = parse_renditions(args_dict["renditions"])
+        if renditions is None:
+            sys.exit(1)
+    max_memory = None
+    if args_dict.get("max_memory"):
+        max_memory = parse_byte_size(args_dict["max_memory"])
+        if max_memory is None:
+            sys.exit(1)
+    target_size = None
+    if args_dict.get("target_size"):
+        target_size = parse_byte_size(args_dict["target_size"])
+        if target_size is None:
+            sys.exit(1)
+    archive_size = None
+    if args_dict.get("archive"):
+        if args_dict.get("incremental") or args_dict.get("watch"):
+            console.print(
+                "[red]--archive cannot be combined with --incremental or --watch.[/red]")
+            sys.exit(1)
+        archive_size = parse_byte_size(args_dict.get("archive_size") or "1GiB")
+        if archive_size is None:
+            sys.exit(1)
+    if input_dir and input_dir.lower().endswith(ARCHIVE_EXTENSIONS) and (
+            args_dict.get("watch") or args_dict.get("incremental") or delete_originals):
+        console.print(
+            "[red]Archive inputs cannot be combined with --watch, --incremental or --delete-originals.[/red]")
+        sys.exit(1)
     if isinstance(quality, str):
         try:
             quality = int(quality)
@@ -394,15 +634,63 @@ def main():
     optimizer = ImageOptimizer(
         input_dir=input_dir,
         output_dir=output_dir,
-        size=parsed_size,
+        size=None if renditions else parsed_size,
         aspect_ratio=aspect,
+        crop_position=crop_position,
+        max_size=max_size,
+        crop_pixels=crop_pixels,
         output_format=_format,
         quality=quality,
         dpi=dpi,
         keep_metadata=keep_metadata,
-        delete_originals=delete_originals
+        delete_originals=delete_originals,
+        workers=workers,
+        incremental=bool(args_dict.get("incremental")),
+        content_hash=bool(args_dict.get("content_hash")),
+        renditions=renditions,
+        rendition_layout=args_dict.get("rendition_layout") or "dirs",
+        streaming=bool(args_dict.get("stream")),
+        io_threads=args_dict.get("io_threads") or 4,
+        max_memory=max_memory,
+        target_size=target_size,
+        passthrough=args_dict.get("passthrough"),
+        dedup=args_dict.get("dedup"),
+        dedup_copy=bool(args_dict.get("dedup_copy")),
+        shard=shard,
+        speed=args_dict.get("speed") or "balanced",
+        archive=args_dict.get("archive"),
+        archive_size=archive_size,
+        metrics_path=args_dict.get("metrics"),
+        event_log=args_dict.get("event_log"),
+        event_rate=args_dict.get("event_rate") if args_dict.get(
+            "event_rate") is not None else 50,
+        progress=not headless
     )
-    optimizer.process_directory()
+    if headless:
+        load_plugins(optimizer.plugin_formats())
+    if args_dict.get("plan"):
+        from planner import RunPlanner, print_report, write_report
+        if input_dir and input_dir.lower().endswith(ARCHIVE_EXTENSIONS):
+            console.print("[red]--plan does not support archive inputs.[/red]")
+            sys.exit(1)
+        report = RunPlanner(optimizer, args_dict.get("plan_sample") or 24).run()
+        print_report(report)
+        if args_dict.get("plan_json"):
+            write_report(report, args_dict["plan_json"])
+    elif args_dict.get("watch"):
+        optimizer.watch_directory(settle=args_dict.get("watch_settle") or 0.5,
+                                  poll_interval=args_dict.get("watch_poll"))
+    elif args_dict.get("profile"):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            optimizer.process_directory()
+        finally:
+            profiler.disable()
+            profiler.dump_stats(args_dict["profile"])
+            console.print(f"Profile written to {args_dict['profile']}")
+    else:
+        optimizer.process_directory()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+PARTIAL_BYTES = 64 << 10
+READ_CHUNK = 1 << 20
+
+
+def file_digest(path, partial=False):
+    # The partial digest covers the first and last PARTIAL_BYTES, which separates almost all
+    # same-size files without reading them in full.
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        if partial:
+            digest.update(f.read(PARTIAL_BYTES))
+            size = os.fstat(f.fileno()).st_size
+            if size > 2 * PARTIAL_BYTES:
+                f.seek(-PARTIAL_BYTES, os.SEEK_END)
+            digest.update(f.read(PARTIAL_BYTES))
+        else:
+            for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def header_key(path, keep_metadata=False):
+    # Everything besides the pixels that changes the output: the source format (used when
+    # no output format is set), the geometry, the frame count and loop of animations and,
+    # with keep_metadata, the EXIF block.
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            key = (img.format, img.mode, img.size, getattr(img, "n_frames", 1), img.info.get("loop"))
+            if keep_metadata:
+                key += (img.info.get("exif"),)
+            return key
+    except Exception:
+        return None
+
+
+def frame_bytes(img):
+    # Palette images store indices, so the palette and the transparent index decide what
+    # they look like; they are compared by the colours they decode to.
+    if img.mode in ("P", "PA") or "transparency" in img.info:
+        return img.convert("RGBA").tobytes()
+    return img.tobytes()
+
+
+def preview_digest(path):
+    # JPEGs decode at 1/8 scale for a fraction of the cost, which splits same-camera photos
+    # that share a header before any of them is decoded in full. Other formats have no
+    # cheap reduced decode and all pass to the full comparison.
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            if img.format != "JPEG":
+                return "full"
+            img.draft(img.mode, (max(1, img.width // 8), max(1, img.height // 8)))
+            return hashlib.blake2b(frame_bytes(img), digest_size=16).hexdigest()
+    except Exception:
+        return None
+
+
+def pixel_digest(path):
+    # Every frame and its duration: animations are rendered in full, so two files that only
+    # share a first frame are not duplicates.
+    from PIL import Image, ImageSequence
+    try:
+        with Image.open(path) as img:
+            digest = hashlib.blake2b(digest_size=16)
+            for frame in ImageSequence.Iterator(img):
+                digest.update(frame_bytes(frame))
+                digest.update(str(frame.info.get("duration")).encode("ascii"))
+            return digest.hexdigest()
+    except Exception:
+        return None
+
+
+def split_groups(groups, key, threads):
+    # Refines every group of two or more paths by `key`; paths whose key is None stay alone.
+    refined = []
+    candidates = [group for group in groups if len(group) > 1]
+    paths = [path for group in candidates for path in group]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        keys = dict(zip(paths, pool.map(key, paths)))
+    for group in candidates:
+        buckets = {}
+        for path in group:
+            if keys[path] is None:
+                continue
+            buckets.setdefault(keys[path], []).append(path)
+        refined += [bucket for bucket in buckets.values() if len(bucket) > 1]
+    return refined
+
+
+def find_duplicates(paths, pixels=False, keep_metadata=False, threads=4):
+    # Returns groups of identical sources in input order, each with at least two paths.
+    # Byte-identical files are found by size, then partial and full digests. With pixels,
+    # the remaining distinct files that share a header are also compared by decoded pixels,
+    # which catches copies that only differ in re-saved metadata.
+    by_size = {}
+    for path in paths:
+        try:
+            by_size.setdefault(os.path.getsize(path), []).append(path)
+        except OSError:
+            continue
+    groups = split_groups(by_size.values(), lambda p: file_digest(p, partial=True), threads)
+    groups = split_groups(groups, file_digest, threads)
+    if not pixels:
+        return groups
+    grouped = {path for group in groups for path in group}
+    # One representative per byte-identical group competes with the ungrouped files.
+    representatives = [group[0] for group in groups]
+    singles = [path for path in paths if path not in grouped]
+    members = {group[0]: group for group in groups}
+    candidates = split_groups([representatives + singles],
+                              lambda p: header_key(p, keep_metadata), threads)
+    candidates = split_groups(candidates, preview_digest, threads)
+    candidates = split_groups(candidates, pixel_digest, threads)
+    merged = []
+    for group in candidates:
+        merged_group = []
+        for path in group:
+            merged_group += members.pop(path, [path])
+        merged.append(merged_group)
+    merged += members.values()
+    order = {path: i for i, path in enumerate(paths)}
+    merged = [sorted(group, key=order.__getitem__) for group in merged]
+    return sorted(merged, key=lambda group: order[group[0]])
@@ -0,0 +1,77 @@
+CROP_ANCHORS = {"center": (0.5, 0.5), "left": (0.0, 0.5), "right": (1.0, 0.5),
+                "top": (0.5, 0.0), "bottom": (0.5, 1.0)}
+
+
+def fit_within(width, height, max_size):
+    max_width, max_height = max_size
+    if width <= max_width and height <= max_height:
+        return width, height
+    aspect_ratio = width / height
+    if width / max_width > height / max_height:
+        return max_width, int(max_width / aspect_ratio)
+    return int(max_height * aspect_ratio), max_height
+
+
+def resized_size(width, height, target):
+    if target["size"]:
+        width, height = target["size"]
+    if target["max_size"]:
+        width, height = fit_within(width, height, target["max_size"])
+    return width, height
+
+
+class GeometryPlan:
+    # Folds the aspect crop, the resize to size/max_size and crop_pixels into one source
+    # box and one output size, so each rendition is a single resize(box=...) call.
+    def __init__(self, aspect_ratio=None, crop_position=None, crop_pixels=None):
+        self.aspect = None
+        if aspect_ratio and crop_position:
+            try:
+                aspect_width, aspect_height = map(int, aspect_ratio.split(":"))
+                self.aspect = aspect_width / aspect_height
+            except Exception:
+                print(f"Invalid aspect ratio format: {aspect_ratio}. Using full image.")
+        self.anchor = CROP_ANCHORS.get(crop_position, (0.5, 0.5))
+        self.margins = None
+        self.single_margin = False
+        if crop_pixels:
+            if len(crop_pixels) == 1:
+                v = crop_pixels[0]
+                self.margins = (v, v, v, v)
+                self.single_margin = True
+            elif len(crop_pixels) == 2:
+                v1, v2 = crop_pixels
+                self.margins = (v1, v1, v2, v1)
+            elif len(crop_pixels) == 4:
+                self.margins = tuple(crop_pixels)
+            else:
+                print("Invalid crop_pixels format. Using no cropping.")
+
+    def crop_box(self, width, height):
+        if not self.aspect:
+            return 0, 0, width, height
+        if width / height > self.aspect:
+            new_width, new_height = int(height * self.aspect), height
+        else:
+            new_width, new_height = width, int(width / self.aspect)
+        anchor_x, anchor_y = self.anchor
+        left = int((width - new_width) * anchor_x)
+        top = int((height - new_height) * anchor_y)
+        return left, top, left + new_width, top + new_height
+
+    def place(self, width, height, target):
+        left, top, right, bottom = self.crop_box(width, height)
+        out_width, out_height = resized_size(right - left, bottom - top, target)
+        if not self.margins:
+            return (left, top, right, bottom), (out_width, out_height)
+        crop_top, crop_right, crop_bottom, crop_left = self.margins
+        if crop_left + crop_right >= out_width or crop_top + crop_bottom >= out_height:
+            if self.single_margin:
+                raise ValueError("Crop_pixels value too high for image dimensions.")
+            raise ValueError("Crop_pixels values too high for image dimensions.")
+        # crop_pixels are measured in output pixels; map them back into source space.
+        scale_x = (right - left) / out_width
+        scale_y = (bottom - top) / out_height
+        box = (left + crop_left * scale_x, top + crop_top * scale_y,
+               right - crop_right * scale_x, bottom - crop_bottom * scale_y)
+        return box, (out_width - crop_left - crop_right, out_height - crop_top - crop_bottom)
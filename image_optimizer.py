@@ -1,10 +1,144 @@
 from PIL import Image
+import importlib
+import io
+import math
 import os
-from tqdm import tqdm
+import signal
+import threading
+import time
+from collections import deque
+from geometry import GeometryPlan, fit_within
+from metrics import EventLog, FileStats, RunMetrics, classify_error
+from pipeline import (SCAN_FAILED, MemoryBudget, copy_file, is_archive, iter_images, link_file,
+                      process_pool, read_source, run_pipeline, write_file)
+
+# tqdm, multiprocessing, the archive reader/writer, the SQLite manifest, the duplicate
+# finder, the animation frame streamer and the watcher are imported where they are used,
+# so a single-process run without those features starts without them.
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.jfif', '.webp', '.gif')
+SAVE_FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP", "gif": "GIF"}
+EXTENSION_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".jfif": "JPEG", ".png": "PNG", ".webp": "WEBP",
+                     ".gif": "GIF"}
+PLUGIN_MODULES = {"JPEG": "JpegImagePlugin", "PNG": "PngImagePlugin", "WEBP": "WebPImagePlugin",
+                  "GIF": "GifImagePlugin"}
+
+# Shrink-on-load: JPEG sources are DCT-scaled to no less than DRAFT_REDUCING_GAP times
+# the target size, other formats are box-reduced to RESIZE_REDUCING_GAP times the target
+# before the final LANCZOS pass.
+DRAFT_REDUCING_GAP = 1.0
+RESIZE_REDUCING_GAP = 3.0
+
+# Encoder effort per --speed profile. None leaves Pillow's default; "balanced" matches the
+# behaviour before profiles existed. reducing_gap only applies with shrink-on-load.
+SPEED_PROFILES = {
+    "fastest": {"resample": Image.BILINEAR, "reducing_gap": 2.0, "webp_method": 0, "webp_lossless_effort": 10,
+                "png_compress_level": 1, "png_optimize": False,
+                "jpeg_optimize": False, "jpeg_progressive": False, "jpeg_subsampling": "4:2:0"},
+    "balanced": {"resample": Image.LANCZOS, "reducing_gap": RESIZE_REDUCING_GAP, "webp_method": None, "webp_lossless_effort": None,
+                 "png_compress_level": None, "png_optimize": False,
+                 "jpeg_optimize": False, "jpeg_progressive": False, "jpeg_subsampling": None},
+    "smallest": {"resample": Image.LANCZOS, "reducing_gap": None, "webp_method": 6, "webp_lossless_effort": 100,
+                 "png_compress_level": 9, "png_optimize": True,
+                 "jpeg_optimize": True, "jpeg_progressive": True, "jpeg_subsampling": "4:2:0"},
+}
+
+# Bytes per pixel of Pillow's in-memory storage; multi-band modes are padded to 4 bytes.
+PIXEL_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2,
+               "I;16L": 2, "I;16B": 2, "I;16N": 2}
+
+# Target-size encoding searches qualities in [TARGET_QUALITY_MIN, quality] and stops once
+# the fitting and non-fitting qualities are within TARGET_QUALITY_TOLERANCE of each other.
+TARGET_QUALITY_MIN = 5
+TARGET_QUALITY_TOLERANCE = 2
+TARGET_MAX_ENCODES = 8
+TARGET_DEFAULT_SEED = 80
+TARGET_FORMATS = ("jpg", "jpeg", "webp")
+
+_worker_optimizer = None
+
+
+def load_plugins(formats):
+    # Registers only these Pillow plugins up front. Saving a format that preinit() does not
+    # cover (WEBP) otherwise makes Pillow call Image.init(), which imports every plugin;
+    # files in any other format still trigger that fallback and open normally.
+    for fmt in formats:
+        if fmt in PLUGIN_MODULES:
+            importlib.import_module(f"PIL.{PLUGIN_MODULES[fmt]}")
+
+
+def describe_error(e):
+    if isinstance(e, Image.DecompressionBombError):
+        return f"exceeds the pixel limit (Image.MAX_IMAGE_PIXELS={Image.MAX_IMAGE_PIXELS}): {e}"
+    return str(e)
+
+
+def search_quality(encode, budget, q_min, q_max, seed):
+    results = {}
+
+    def fits(quality):
+        results[quality] = encode(quality)
+        return len(results[quality]) <= budget
+
+    fitting = failing = None
+    quality = min(max(seed, q_min), q_max)
+    step = TARGET_QUALITY_TOLERANCE
+    while len(results) < TARGET_MAX_ENCODES:
+        if fits(quality):
+            fitting = quality
+            if quality == q_max:
+                break
+        else:
+            failing = quality
+            if quality == q_min:
+                break
+        if fitting is not None and failing is not None:
+            if failing - fitting <= TARGET_QUALITY_TOLERANCE:
+                break
+            next_quality = (fitting + failing) // 2
+        elif fitting is not None:
+            next_quality = min(q_max, quality + step)
+            step *= 2
+        else:
+            next_quality = max(q_min, quality - step)
+            step *= 2
+        if next_quality in results:
+            break
+        quality = next_quality
+    if fitting is None:
+        # Even the lowest quality is over budget; keep the smallest encode.
+        fitting = min(results, key=lambda q: len(results[q]))
+    return fitting, results[fitting], len(results)
+
+
+def _init_worker(optimizer):
+    global _worker_optimizer
+    _worker_optimizer = optimizer
+
+
+def _process_in_worker(job):
+    file_path, output_dir_for_file = job
+    stats = FileStats()
+    try:
+        return file_path, _worker_optimizer._process_image(file_path, output_dir_for_file, stats), None, stats
+    except Exception as e:
+        stats.error_class = type(e).__name__
+        return file_path, [], describe_error(e), stats
+
+
+def _render_in_worker(file_path, output_dir_for_file, data, archive_path=None):
+    stats = FileStats()
+    if archive_path:
+        from archive import open_archive
+        archive = open_archive(archive_path)
+        source, stats.bytes_in = archive.open_member(data), archive.member_size(data)
+    else:
+        source, stats.bytes_in = io.BytesIO(data), len(data)
+    return file_path, _worker_optimizer.render(source, file_path, output_dir_for_file, stats), stats
 
 
 class ImageOptimizer:
-    def __init__(self, input_dir, output_dir, size=None, aspect_ratio=None, crop_position=None, max_size=None, crop_pixels=None, output_format=None, quality=100, dpi=None, keep_metadata=False, delete_originals=False):
+    def __init__(self, input_dir, output_dir, size=None, aspect_ratio=None, crop_position=None, max_size=None, crop_pixels=None, output_format=None, quality=100, dpi=None, keep_metadata=False, delete_originals=False, workers=1, shrink_on_load=True, incremental=False, content_hash=False, renditions=None, rendition_layout="dirs", streaming=False, io_threads=4, max_memory=None, metrics_path=None, event_log=None, event_rate=50, target_size=None, passthrough=None, speed="balanced", archive=None, archive_size=1 << 30, progress=True, dedup=None, dedup_copy=False, shard=None):
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.size = size
@@ -18,143 +152,931 @@ class ImageOptimizer:
         self.dpi = dpi
         self.keep_metadata = keep_metadata
         self.delete_originals = delete_originals
+        self.workers = max(1, int(workers or 1))
+        self.shrink_on_load = shrink_on_load
+        self.speed = speed or "balanced"
+        self.profile = SPEED_PROFILES[self.speed]
+        self.reducing_gap = self.profile["reducing_gap"] if shrink_on_load else None
+        self.incremental = incremental
+        self.content_hash = content_hash
+        self.renditions = renditions
+        self.rendition_layout = rendition_layout
+        self.targets = self.build_targets()
+        self.plan = GeometryPlan(aspect_ratio, crop_position, crop_pixels)
+        self.streaming = streaming
+        self.io_threads = max(1, int(io_threads or 1))
+        self.max_memory = max_memory
+        self.target_size = target_size
+        self.passthrough = passthrough
+        self.archive = archive
+        self.archive_size = archive_size
+        self.dedup = dedup
+        self.dedup_copy = dedup_copy
+        self.shard = shard
+        self.shard_log = None
+        self.archive_writer = None
+        self.source_archive = None
+        self._quality_history = {}
+        self.metrics_path = metrics_path
+        self.event_log = event_log
+        self.event_rate = event_rate
+        self.progress_bar = progress
+        self.metrics = RunMetrics()
+        self.events = None
+        self.hooks = []
+        self._created_dirs = set()
+
+    def __getstate__(self):
+        # Worker processes only render; run-level metrics, the event stream and hooks
+        # stay in the coordinating process.
+        state = self.__dict__.copy()
+        state["metrics"] = None
+        state["events"] = None
+        state["hooks"] = []
+        state["archive_writer"] = None
+        state["source_archive"] = None
+        state["shard_log"] = None
+        return state
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
 
+    def progress(self, iterable, **kwargs):
+        if not self.progress_bar:
+            return iterable
+        from tqdm import tqdm
+        return tqdm(iterable, desc="Processing images", **kwargs)
+
+    def plugin_formats(self):
+        # Pillow formats this run reads or writes; a single input file only needs its own.
+        extensions = IMAGE_EXTENSIONS
+        if self.input_dir and os.path.isfile(self.input_dir):
+            extensions = (os.path.splitext(self.input_dir)[1].lower(),)
+        formats = {EXTENSION_FORMATS[ext] for ext in extensions if ext in EXTENSION_FORMATS}
+        for target in self.targets:
+            fmts = target["format"] if isinstance(target["format"], list) else [target["format"]]
+            formats.update(SAVE_FORMATS[f.lower()] for f in fmts
+                           if f and f.lower() in SAVE_FORMATS)
+        return formats
+
+    def build_targets(self):
+        if not self.renditions:
+            return [{"label": None, "size": self.size, "max_size": self.max_size,
+                     "format": self.output_format, "quality": self.quality}]
+        targets = []
+        for rendition in self.renditions:
+            size = rendition.get("size")
+            max_size = rendition.get("max_size")
+            fmt = rendition.get("format") or self.output_format
+            label = rendition.get("label") or (
+                f"{size[0]}x{size[1]}" if size else str(max(max_size)))
+            quality = rendition.get("quality")
+            targets.append({"label": label, "size": size, "max_size": max_size,
+                            "format": fmt.lower() if isinstance(fmt, str) else fmt,
+                            "quality": self.quality if quality is None else quality})
+        # Largest first, so every rendition can be downscaled from the previous one.
+        targets.sort(key=lambda t: max(t["size"] or t["max_size"]), reverse=True)
+        return targets
+
+    def settings_fingerprint(self):
+        return {
+            "size": self.size,
+            "aspect_ratio": self.aspect_ratio,
+            "crop_position": self.crop_position,
+            "max_size": self.max_size,
+            "crop_pixels": self.crop_pixels,
+            "output_format": self.output_format,
+            "quality": self.quality,
+            "dpi": self.dpi,
+            "keep_metadata": self.keep_metadata,
+            "shrink_on_load": self.shrink_on_load,
+            "targets": self.targets,
+            "rendition_layout": self.rendition_layout,
+            "target_size": self.target_size,
+            "passthrough": bool(self.passthrough),
+            "speed": self.speed,
+        }
+
+    def target_scale(self, width, height):
+        scale = 0.0
+        for target in self.targets:
+            (left, top, right, bottom), (out_width, out_height) = self.plan.place(
+                width, height, target)
+            scale = max(scale, out_width / (right - left),
+                        out_height / (bottom - top))
+        return scale
+
+    def plan_decode(self, img):
+        if not self.shrink_on_load or not any(t["size"] or t["max_size"] for t in self.targets):
+            return
+        width, height = img.size
+        scale = self.target_scale(width, height) * DRAFT_REDUCING_GAP
+        if scale >= 1:
+            return
+        img.draft(img.mode, (max(1, math.ceil(width * scale)),
+                             max(1, math.ceil(height * scale))))
+
+    def estimate_memory(self, source):
+        with Image.open(source) as img:
+            return self.image_memory(img)
+
+    def image_memory(self, img):
+        # Header-only: draft() only picks the JPEG DCT scale, nothing is decoded here.
+        self.plan_decode(img)
+        width, height = img.size
+        pixel_bytes = PIXEL_BYTES.get(img.mode, 4)
+        outputs = sorted((w * h for _, (w, h) in (self.plan.place(width, height, t)
+                                                  for t in self.targets)), reverse=True)
+        # Decoded image and at most two renditions alive at once, each with a reduce()
+        # intermediate of the same order of size.
+        pixels = width * height + 2 * sum(outputs[:2])
+        if getattr(img, "is_animated", False):
+            # Animations stream: a copy of the canvas and its resized frame per frame in flight.
+            pixels += self.frame_lookahead() * (width * height + outputs[0])
+            pixel_bytes = 4
+        return pixels * pixel_bytes
+
+    def target_formats(self, target, source_format):
+        if target["format"]:
+            if isinstance(target["format"], list):
+                return target["format"]
+            return [target["format"]]
+        if source_format:
+            return [source_format.lower()]
+        return ["png"]
+
+    def can_pass_through(self, img, source_bytes):
+        # Header-only check: the source already has the output format and geometry, so its
+        # bytes can be copied instead of decoded and re-encoded.
+        if getattr(img, "is_animated", False):
+            return False
+        if not self.keep_metadata and "exif" in img.info:
+            return False
+        if self.dpi and tuple(round(v) for v in img.info.get("dpi", ())) != (self.dpi, self.dpi):
+            return False
+        if self.target_size and source_bytes > self.target_size:
+            return False
+        for target in self.targets:
+            formats = self.target_formats(target, img.format)
+            if len(formats) != 1 or SAVE_FORMATS.get(formats[0].lower()) != img.format:
+                return False
+            box, size = self.plan.place(img.width, img.height, target)
+            if tuple(box) != (0, 0) + img.size or size != img.size:
+                return False
+        return True
+
+    def output_path(self, file_path, output_dir_for_file, target, fmt):
+        base_name = os.path.splitext(os.path.basename(file_path))[0]
+        if target["label"] is not None:
+            if self.rendition_layout == "suffix":
+                base_name += "_" + target["label"]
+            else:
+                relative_path = os.path.relpath(
+                    output_dir_for_file, self.output_dir)
+                output_dir_for_file = os.path.normpath(os.path.join(
+                    self.output_dir, target["label"], relative_path))
+        return os.path.join(output_dir_for_file, base_name + "." + fmt.lower())
+
+    def save_kwargs(self, fmt, quality, original_info):
+        save_kwargs = {}
+        profile = self.profile
+        if fmt.lower() in ['jpg', 'jpeg']:
+            save_kwargs["quality"] = quality
+            if self.keep_metadata and "exif" in original_info:
+                save_kwargs["exif"] = original_info["exif"]
+            save_kwargs["optimize"] = profile["jpeg_optimize"]
+            save_kwargs["progressive"] = profile["jpeg_progressive"]
+            if profile["jpeg_subsampling"]:
+                save_kwargs["subsampling"] = profile["jpeg_subsampling"]
+        elif fmt.lower() == "webp":
+            if quality < 100:
+                save_kwargs["quality"] = quality
+                save_kwargs["lossless"] = False
+            else:
+                # In lossless mode Pillow's quality is the compression effort.
+                save_kwargs["quality"] = profile["webp_lossless_effort"] or quality
+                save_kwargs["lossless"] = True
+            if profile["webp_method"] is not None:
+                save_kwargs["method"] = profile["webp_method"]
+        elif fmt.lower() == "png":
+            save_kwargs["optimize"] = profile["png_optimize"]
+            if profile["png_compress_level"] is not None:
+                save_kwargs["compress_level"] = profile["png_compress_level"]
+        if self.dpi:
+            save_kwargs["dpi"] = (self.dpi, self.dpi)
+        return save_kwargs
+
+    def encode(self, img, fmt, quality, original_info, lossless=None):
+        save_format = "JPEG" if fmt.lower() == "jpg" else fmt.upper()
+        if save_format == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+        save_kwargs = self.save_kwargs(fmt, quality, original_info)
+        if lossless is not None and "lossless" in save_kwargs:
+            save_kwargs["lossless"] = lossless
+        buffer = io.BytesIO()
+        img.save(buffer, save_format, **save_kwargs)
+        return buffer.getvalue()
+
+    def encode_to_target(self, img, fmt, max_quality, original_info, stats):
+        if img.mode not in ("RGB", "L", "CMYK") and fmt.lower() in ("jpg", "jpeg"):
+            img = img.convert("RGB")
+        # Images of the same format at a similar bits-per-pixel budget settle at similar
+        # qualities, so the last result for that bucket seeds the next search.
+        bits_per_pixel = self.target_size * 8 / (img.width * img.height)
+        bucket = (fmt.lower(), round(math.log2(bits_per_pixel) * 2))
+        seed = self._quality_history.get(bucket, min(
+            TARGET_DEFAULT_SEED, max_quality))
+        quality, data, encodes = search_quality(
+            lambda q: self.encode(img, fmt, q, original_info, lossless=False),
+            self.target_size, TARGET_QUALITY_MIN, min(max_quality, 99), seed)
+        self._quality_history[bucket] = quality
+        stats.encodes += encodes
+        if len(data) > self.target_size:
+            stats.target_misses += 1
+        return data
+
+    @staticmethod
+    def map_box(box, outer, size):
+        # Maps `box` (base coordinates) into an image of `size` that covers `outer`.
+        if box[0] < outer[0] or box[1] < outer[1] or box[2] > outer[2] or box[3] > outer[3]:
+            return None
+        scale_x = size[0] / (outer[2] - outer[0])
+        scale_y = size[1] / (outer[3] - outer[1])
+        return ((box[0] - outer[0]) * scale_x, (box[1] - outer[1]) * scale_y,
+                (box[2] - outer[0]) * scale_x, (box[3] - outer[1]) * scale_y)
+
+    # Single-step helpers kept for callers of the pre-GeometryPlan API; the pipeline itself
+    # runs the fused plan through resample().
     def crop_image(self, image, aspect_ratio):
-        width, height = image.size
-        try:
-            aspect_width, aspect_height = map(int, aspect_ratio.split(":"))
-        except Exception as e:
-            print(
-                f"Invalid aspect ratio format: {aspect_ratio}. Using full image.")
+        plan = GeometryPlan(aspect_ratio, self.crop_position or "center")
+        if not plan.aspect:
             return image
-        aspect_value = aspect_width / aspect_height
-        if width / height > aspect_value:
-            new_width = int(height * aspect_value)
-            new_height = height
-        else:
-            new_width = width
-            new_height = int(width / aspect_value)
-        if self.crop_position == "center":
-            left = (width - new_width) // 2
-            top = (height - new_height) // 2
-        elif self.crop_position == "left":
-            left = 0
-            top = (height - new_height) // 2
-        elif self.crop_position == "right":
-            left = width - new_width
-            top = (height - new_height) // 2
-        elif self.crop_position == "top":
-            left = (width - new_width) // 2
-            top = 0
-        elif self.crop_position == "bottom":
-            left = (width - new_width) // 2
-            top = height - new_height
-        else:
-            left = (width - new_width) // 2
-            top = (height - new_height) // 2
-        return image.crop((left, top, left + new_width, top + new_height))
-
-    def resize_within_max_size(self, img):
-        if self.max_size:
-            width, height = img.size
-            max_width, max_height = self.max_size
-            aspect_ratio = width / height
-            if width > max_width or height > max_height:
-                if width / max_width > height / max_height:
-                    new_width = max_width
-                    new_height = int(new_width / aspect_ratio)
-                else:
-                    new_height = max_height
-                    new_width = int(new_height * aspect_ratio)
-                img = img.resize((new_width, new_height), Image.LANCZOS)
+        return image.crop(plan.crop_box(*image.size))
+
+    def resize_within_max_size(self, img, max_size=None):
+        max_size = max_size or self.max_size
+        if max_size:
+            new_size = fit_within(img.width, img.height, max_size)
+            if new_size != img.size:
+                img = img.resize(new_size, self.profile["resample"], reducing_gap=self.reducing_gap)
         return img
 
     def crop_by_pixels(self, img):
-        if self.crop_pixels:
-            width, height = img.size
-            if len(self.crop_pixels) == 1:
-                v = self.crop_pixels[0]
-                if 2 * v >= width or 2 * v >= height:
-                    raise ValueError(
-                        "Crop_pixels value too high for image dimensions.")
-                crop_top = crop_bottom = crop_left = crop_right = v
-            elif len(self.crop_pixels) == 2:
-                v1, v2 = self.crop_pixels
-                if 2 * v1 >= width or (v1 + v2) >= height:
-                    raise ValueError(
-                        "Crop_pixels values too high for image dimensions.")
-                crop_top, crop_bottom = v1, v2
-                crop_left = crop_right = v1
-            elif len(self.crop_pixels) == 4:
-                crop_top, crop_right, crop_bottom, crop_left = self.crop_pixels
-                if (crop_left + crop_right) >= width or (crop_top + crop_bottom) >= height:
-                    raise ValueError(
-                        "Crop_pixels values too high for image dimensions.")
-            else:
-                print("Invalid crop_pixels format. Using no cropping.")
-                return img
-            img = img.crop((crop_left, crop_top, width -
-                           crop_right, height - crop_bottom))
-        return img
+        plan = GeometryPlan(crop_pixels=self.crop_pixels)
+        if not plan.margins:
+            return img
+        box, _ = plan.place(img.width, img.height, {"size": None, "max_size": None})
+        return img.crop(tuple(int(v) for v in box))
 
-    def process_image(self, file_path, output_dir_for_file):
+    def resample(self, img, box, size):
+        if tuple(box) == (0, 0) + img.size and size == img.size:
+            return img
+        if all(float(v).is_integer() for v in box) and size == (box[2] - box[0], box[3] - box[1]):
+            return img.crop(tuple(int(v) for v in box))
+        return img.resize(size, self.profile["resample"], box=box, reducing_gap=self.reducing_gap)
+
+    def frame_threads(self):
+        # Frames of one animation are resized in parallel on the CPUs this worker's share
+        # of the machine leaves it.
+        return max(1, (os.cpu_count() or 1) // self.workers)
+
+    def frame_lookahead(self):
+        return 2 * self.frame_threads()
+
+    def encode_animation(self, img, box, size, fmt, quality, original_info, pool, stats, lossless=None):
+        from animation import AnimatedFrames, FrameDurations, source_loop
+        start = time.perf_counter()
+        frames = AnimatedFrames(img, lambda frame: self.resample(frame, box, size),
+                                pool, self.frame_lookahead())
+        save_kwargs = self.save_kwargs(fmt, quality, original_info)
+        if lossless is not None and "lossless" in save_kwargs:
+            save_kwargs["lossless"] = lossless
+        loop = source_loop(img)
+        if fmt.lower() == "webp":
+            # WebP has no play-once flag besides a loop count of 1.
+            save_kwargs["loop"] = 1 if loop is None else loop
+        elif loop is not None:
+            save_kwargs["loop"] = loop
+        if fmt.lower() == "gif":
+            # Frames are full canvases; without clearing the previous one, pixels a later
+            # frame makes transparent would keep the earlier frame's colour.
+            save_kwargs["disposal"] = 2
+        buffer = io.BytesIO()
         try:
-            with Image.open(file_path) as img:
-                original_info = img.info if self.keep_metadata else {}
-                if self.aspect_ratio and self.crop_position:
-                    img = self.crop_image(img, self.aspect_ratio)
-                if self.size:
-                    img = img.resize(self.size, Image.LANCZOS)
-                if self.max_size:
-                    img = self.resize_within_max_size(img)
-                if self.crop_pixels:
-                    img = self.crop_by_pixels(img)
-                out_formats = []
-                if self.output_format:
-                    if isinstance(self.output_format, list):
-                        out_formats = self.output_format
+            frames.save(buffer, SAVE_FORMATS[fmt.lower()], save_all=True,
+                        duration=FrameDurations(frames), **save_kwargs)
+        finally:
+            frames.close()
+        stats.add("decode", frames.decode_seconds)
+        stats.add("resize", frames.wait_seconds)
+        stats.add("encode", time.perf_counter() - start - frames.decode_seconds - frames.wait_seconds)
+        return buffer.getvalue()
+
+    def render_animation(self, img, source_format, original_info, stats):
+        # Every (target, format) pass streams the frames again instead of keeping them.
+        from concurrent.futures import ThreadPoolExecutor
+        from animation import ANIMATED_FORMATS, frame_mode
+        outputs = []
+        n_frames = img.n_frames
+        stats.pixels_in = img.width * img.height * n_frames
+        with ThreadPoolExecutor(max_workers=self.frame_threads()) as pool:
+            for target in self.targets:
+                box, new_size = self.plan.place(img.width, img.height, target)
+                for fmt in self.target_formats(target, source_format):
+                    if fmt.lower() not in ANIMATED_FORMATS:
+                        img.seek(0)
+                        with stats.stage("decode"):
+                            frame = img.convert(frame_mode(img))
+                        with stats.stage("resize"):
+                            out = self.resample(frame, box, new_size)
+                        with stats.stage("encode"):
+                            if self.target_size and fmt.lower() in TARGET_FORMATS:
+                                data = self.encode_to_target(
+                                    out, fmt, target["quality"], original_info, stats)
+                            else:
+                                data = self.encode(out, fmt, target["quality"], original_info)
+                                stats.encodes += 1
+                        outputs.append((target, fmt, data))
+                        stats.pixels_out += out.width * out.height
+                        continue
+                    if self.target_size and fmt.lower() in TARGET_FORMATS:
+                        quality, data, encodes = search_quality(
+                            lambda q: self.encode_animation(img, box, new_size, fmt, q, original_info,
+                                                            pool, stats, lossless=False),
+                            self.target_size, TARGET_QUALITY_MIN, min(target["quality"], 99),
+                            min(TARGET_DEFAULT_SEED, target["quality"]))
+                        stats.encodes += encodes
+                        if len(data) > self.target_size:
+                            stats.target_misses += 1
                     else:
-                        out_formats = [self.output_format]
+                        data = self.encode_animation(img, box, new_size, fmt, target["quality"],
+                                                     original_info, pool, stats)
+                        stats.encodes += 1
+                    outputs.append((target, fmt, data))
+                    stats.pixels_out += new_size[0] * new_size[1] * n_frames
+        return outputs
+
+    def ensure_dir(self, directory, refresh=False):
+        # refresh bypasses the cache for a directory removed after it was created, which a
+        # long-running --watch process would otherwise never recreate.
+        if refresh or directory not in self._created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._created_dirs.add(directory)
+
+    def render(self, source, file_path, output_dir_for_file, stats=None):
+        return [(self.output_path(file_path, output_dir_for_file, target, fmt), data)
+                for target, fmt, data in self.render_targets(source, file_path, stats)]
+
+    def render_targets(self, source, file_path, stats=None):
+        stats = stats or FileStats()
+        outputs = []
+        try:
+            img = Image.open(source)
+        except Image.UnidentifiedImageError:
+            raise Image.UnidentifiedImageError(
+                f"cannot identify image file '{file_path}'") from None
+        with img:
+            original_info = img.info if self.keep_metadata else {}
+            source_format = img.format
+            stats.pixels_in = img.width * img.height
+            if self.passthrough and self.can_pass_through(img, stats.bytes_in):
+                stats.passthrough = True
+                # None tells write_outputs to copy the source file itself.
+                data = None
+                if not isinstance(source, str):
+                    source.seek(0)
+                    data = source.read()
+                for target in self.targets:
+                    outputs.append(
+                        (target, self.target_formats(target, source_format)[0], data))
+                    stats.pixels_out += img.width * img.height
+                return outputs
+            if getattr(img, "is_animated", False):
+                return self.render_animation(img, source_format, original_info, stats)
+            with stats.stage("decode"):
+                self.plan_decode(img)
+                img.load()
+            base = img
+            previous = previous_box = None
+            for target in self.targets:
+                box, new_size = self.plan.place(base.width, base.height, target)
+                # Each rendition is downscaled from the previous (larger) one when that still
+                # covers the requested box, instead of resampling the full-size base again.
+                source, source_box = base, box
+                if previous is not None:
+                    mapped = self.map_box(box, previous_box, previous.size)
+                    if mapped is not None and previous.width * (box[2] - box[0]) >= new_size[0] * (previous_box[2] - previous_box[0]) \
+                            and previous.height * (box[3] - box[1]) >= new_size[1] * (previous_box[3] - previous_box[1]):
+                        source, source_box = previous, mapped
+                with stats.stage("resize"):
+                    out = self.resample(source, source_box, new_size)
+                previous, previous_box = out, box
+                for fmt in self.target_formats(target, source_format):
+                    with stats.stage("encode"):
+                        if self.target_size and fmt.lower() in TARGET_FORMATS:
+                            data = self.encode_to_target(
+                                out, fmt, target["quality"], original_info, stats)
+                        else:
+                            data = self.encode(
+                                out, fmt, target["quality"], original_info)
+                            stats.encodes += 1
+                    outputs.append((target, fmt, data))
+                    stats.pixels_out += out.width * out.height
+        return outputs
+
+    def process_bytes(self, data, stats=None):
+        # Bytes in, {format: bytes} out; renditions are keyed "<label>/<format>".
+        stats = stats or FileStats()
+        stats.bytes_in = len(data)
+        outputs = {}
+        for target, fmt, encoded in self.render_targets(io.BytesIO(data), "<bytes>", stats):
+            key = fmt.lower() if target["label"] is None else f"{target['label']}/{fmt.lower()}"
+            outputs[key] = encoded
+            stats.bytes_out += len(encoded)
+        return outputs
+
+    def write_outputs(self, file_path, outputs, stats=None):
+        stats = stats or FileStats()
+        output_paths = []
+        with stats.stage("write"):
+            if self.archive_writer:
+                self.write_to_archive(file_path, outputs, stats, output_paths)
+                outputs = []
+            for output_path, data in outputs:
+                self.ensure_dir(os.path.dirname(output_path))
+                try:
+                    self.write_output(file_path, output_path, data)
+                except FileNotFoundError:
+                    self.ensure_dir(os.path.dirname(output_path), refresh=True)
+                    self.write_output(file_path, output_path, data)
+                stats.bytes_out += stats.bytes_in if data is None else len(data)
+                output_paths.append(output_path)
+            if self.delete_originals and not self.source_archive:
+                os.remove(file_path)
+        return output_paths
+
+    def write_output(self, file_path, output_path, data):
+        # None means passthrough: the source file itself becomes the output.
+        if data is None:
+            if os.path.abspath(output_path) != os.path.abspath(file_path):
+                if self.passthrough == "link":
+                    link_file(file_path, output_path)
                 else:
-                    if img.format:
-                        out_formats = [img.format.lower()]
-                    else:
-                        out_formats = ["png"]
-                for fmt in out_formats:
-                    base_name = os.path.splitext(os.path.basename(file_path))[
-                        0] + "." + fmt.lower()
-                    output_path = os.path.join(output_dir_for_file, base_name)
-                    save_kwargs = {}
-                    if fmt.lower() in ['jpg', 'jpeg']:
-                        save_kwargs["quality"] = self.quality
-                        if self.keep_metadata and "exif" in original_info:
-                            save_kwargs["exif"] = original_info["exif"]
-                    elif fmt.lower() == "webp":
-                        if self.quality < 100:
-                            save_kwargs["quality"] = self.quality
-                            save_kwargs["lossless"] = False
+                    copy_file(file_path, output_path)
+            return
+        write_file(output_path, data)
+
+    def write_to_archive(self, file_path, outputs, stats, output_paths):
+        for output_path, data in outputs:
+            if data is None:
+                with open(file_path, "rb") as f:
+                    data = f.read()
+            name = os.path.relpath(output_path, self.output_dir).replace(os.sep, "/")
+            output_paths.append(self.archive_writer.add(name, data))
+            stats.bytes_out += len(data)
+
+    def _process_image(self, file_path, output_dir_for_file, stats=None):
+        stats = stats or FileStats()
+        stats.bytes_in = os.path.getsize(file_path)
+        return self.write_outputs(file_path, self.render(file_path, file_path, output_dir_for_file, stats), stats)
+
+    def dedup_jobs(self, jobs):
+        # Only the first job of every group of identical sources is rendered; the others get
+        # links to its outputs once it finishes. Returns (jobs, {leader: (dir, copies)}).
+        from dedup import find_duplicates
+        start = time.perf_counter()
+        pixels = self.dedup == "pixels"
+        if pixels and self.passthrough:
+            print("Passthrough copies source bytes, so duplicates are matched by bytes only.")
+            pixels = False
+        job_dirs = dict(jobs)
+        groups = find_duplicates(list(job_dirs), pixels, self.keep_metadata, self.io_threads)
+        duplicates = {}
+        followers = set()
+        for leader, *copies in groups:
+            duplicates[leader] = (job_dirs[leader], [(path, job_dirs[path]) for path in copies])
+            followers.update(copies)
+        print(f"Dedup: {len(followers)} duplicate sources in {len(groups)} groups "
+              f"({time.perf_counter() - start:.1f}s to compare {len(jobs)} files)")
+        return [job for job in jobs if job[0] not in followers], duplicates
+
+    def link_duplicate(self, leader, leader_dir, leader_outputs, file_path, output_dir_for_file, stats):
+        output_paths = []
+        with stats.stage("write"):
+            for output in leader_outputs:
+                # Outputs are matched back to their target through the path they were given.
+                fmt = os.path.splitext(output)[1][1:]
+                for target in self.targets:
+                    if self.output_path(leader, leader_dir, target, fmt) != output:
+                        continue
+                    output_path = self.output_path(file_path, output_dir_for_file, target, fmt)
+                    if output_path != output:
+                        # Every later write replaces its output with a new file, so
+                        # re-rendering either source breaks the link instead of
+                        # changing both outputs.
+                        self.ensure_dir(os.path.dirname(output_path))
+                        if self.dedup_copy:
+                            copy_file(output, output_path)
                         else:
-                            save_kwargs["quality"] = self.quality
-                            save_kwargs["lossless"] = True
-                    if self.dpi:
-                        save_kwargs["dpi"] = (self.dpi, self.dpi)
-                    img.save(output_path, fmt.upper(), **save_kwargs)
-                    print(f"Processed: {file_path} -> {output_path}")
+                            link_file(output, output_path)
+                    stats.bytes_out += os.path.getsize(output_path)
+                    output_paths.append(output_path)
+                    break
             if self.delete_originals:
                 os.remove(file_path)
-                print(f"Deleted original: {file_path}")
+        return output_paths
+
+    def report_duplicates(self, leader, output_paths, error, leader_stats, duplicates, manifest, states):
+        leader_dir, copies = duplicates.pop(leader, (None, ()))
+        for file_path, output_dir_for_file in copies:
+            stats = FileStats()
+            stats.duplicate_of = leader
+            stats.bytes_in = os.path.getsize(file_path)
+            copy_error, copy_paths = error, []
+            if error:
+                stats.error_class = leader_stats.error_class if leader_stats else None
+            else:
+                stats.seconds_saved = leader_stats.total_seconds() if leader_stats else 0.0
+                try:
+                    copy_paths = self.link_duplicate(leader, leader_dir, output_paths,
+                                                     file_path, output_dir_for_file, stats)
+                except Exception as e:
+                    copy_error = e
+                    stats.error_class = type(e).__name__
+            self.report_result(file_path, copy_paths, copy_error, stats)
+            if manifest and not copy_error:
+                if file_path in states:
+                    manifest.record(file_path, states.pop(file_path), copy_paths)
+
+    def report_result(self, file_path, output_paths, error=None, stats=None):
+        if self.metrics:
+            self.metrics.observe(output_paths, error, stats)
+        if self.shard_log:
+            self.shard_log.record(file_path, output_paths, error)
+        for hook in self.hooks:
+            hook(file_path, output_paths, error, stats)
+        events = self.events or EventLog(rate=0)
+        if error:
+            events.emit("error", force=True, file=file_path, error_class=classify_error(error, stats),
+                        error=describe_error(error) if isinstance(error, Exception) else error)
+            return
+        events.emit("processed", file=file_path, outputs=output_paths,
+                    deleted=self.delete_originals,
+                    passthrough=bool(stats and stats.passthrough),
+                    duplicate_of=stats.duplicate_of if stats else None,
+                    ms=round(stats.total_seconds() * 1000, 2) if stats else None)
+
+    def process_image(self, file_path, output_dir_for_file):
+        stats = FileStats()
+        try:
+            output_paths = self._process_image(
+                file_path, output_dir_for_file, stats)
         except Exception as e:
-            print(f"Error processing {file_path}: {e}")
+            stats.error_class = type(e).__name__
+            self.report_result(file_path, [], e, stats)
+            return None
+        self.report_result(file_path, output_paths, None, stats)
+        return output_paths
 
-    def process_directory(self):
+    def collect_images(self):
+        if os.path.isfile(self.input_dir):
+            # A single image as input is written directly into output_dir.
+            return list(iter_images(self.input_dir, IMAGE_EXTENSIONS))
         image_files = []
         for root, dirs, files in os.walk(self.input_dir):
             for file in files:
-                if file.lower().endswith(('.jpg', '.jpeg', '.png', '.jfif', '.webp')):
+                if file.lower().endswith(IMAGE_EXTENSIONS):
                     file_path = os.path.join(root, file)
                     relative_path = os.path.relpath(root, self.input_dir)
                     image_files.append((file_path, relative_path))
-        for file_path, relative_path in tqdm(image_files, desc="Processing images"):
-            output_dir_for_file = os.path.join(self.output_dir, relative_path)
-            os.makedirs(output_dir_for_file, exist_ok=True)
-            self.process_image(file_path, output_dir_for_file)
+        return image_files
+
+    def iter_jobs(self, image_files, manifest=None, states=None):
+        for file_path, relative_path in image_files:
+            if manifest:
+                try:
+                    fresh, state = manifest.check(file_path)
+                except OSError:
+                    # Gone since the walk, or a dangling link: processing reports the error
+                    # for this file and the scan carries on.
+                    yield file_path, os.path.normpath(os.path.join(self.output_dir, relative_path))
+                    continue
+                if fresh:
+                    if self.shard_log:
+                        self.shard_log.record_unchanged(file_path)
+                    continue
+                states[file_path] = state
+            yield file_path, os.path.normpath(os.path.join(self.output_dir, relative_path))
+
+    def make_executor(self, max_workers):
+        return process_pool(max_workers, _init_worker, (self,))
+
+    def run_jobs(self, jobs):
+        if self.workers == 1 or len(jobs) < 2:
+            for file_path, output_dir_for_file in self.progress(jobs):
+                stats = FileStats()
+                try:
+                    yield file_path, self._process_image(file_path, output_dir_for_file, stats), None, stats
+                except Exception as e:
+                    stats.error_class = type(e).__name__
+                    yield file_path, [], e, stats
+            return
+        # Largest files first so a single huge image does not stretch the tail of the batch.
+        jobs = sorted(jobs, key=lambda job: self.source_size(job[0]), reverse=True)
+        with self.make_executor(min(self.workers, len(jobs))) as executor:
+            if self.max_memory:
+                results = self.run_budgeted(executor, jobs)
+            else:
+                results = executor.map(_process_in_worker, jobs, chunksize=1)
+            yield from self.progress(results, total=len(jobs))
+
+    @staticmethod
+    def source_size(file_path):
+        # Files that vanished or became unreadable since the walk sort last; their worker
+        # reports the error for that file alone.
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    def run_budgeted(self, executor, jobs):
+        from concurrent.futures import Future
+        budget = MemoryBudget(self.max_memory)
+        pending = deque()
+        for job in jobs:
+            try:
+                cost = self.estimate_memory(job[0])
+            except Exception as e:
+                future = Future()
+                future.set_result((job[0], [], e, None))
+                pending.append(future)
+                continue
+            while not budget.acquire(cost, timeout=0.1):
+                while pending and pending[0].done():
+                    yield pending.popleft().result()
+            future = executor.submit(_process_in_worker, job)
+            future.add_done_callback(
+                lambda _, cost=cost: budget.release(cost))
+            pending.append(future)
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def run_streaming(self, jobs, archive=None):
+        # With an archive, jobs carry member references instead of paths; workers map the
+        # archive themselves so stored members are never copied between processes.
+        read = archive.read_member if archive else read_source
+        archive_path = archive.path if archive else None
+
+        def open_source(data):
+            if archive:
+                return archive.open_member(data), archive.member_size(data)
+            return io.BytesIO(data), len(data)
+
+        if self.workers == 1:
+            def render_bytes(file_path, output_dir_for_file, data):
+                stats = FileStats()
+                source, stats.bytes_in = open_source(data)
+                return file_path, self.render(source, file_path, output_dir_for_file, stats), stats
+
+            results = run_pipeline(jobs, render_bytes, self.write_outputs,
+                                   1, self.io_threads, read=read)
+            yield from self.progress(results, unit="img")
+            return
+        budget = MemoryBudget(self.max_memory) if self.max_memory else None
+
+        def transform(file_path, output_dir_for_file, data):
+            if not budget:
+                return executor.submit(_render_in_worker, file_path, output_dir_for_file, data, archive_path).result()
+            cost = self.estimate_memory(open_source(data)[0])
+            budget.acquire(cost)
+            try:
+                return executor.submit(_render_in_worker, file_path, output_dir_for_file, data, archive_path).result()
+            finally:
+                budget.release(cost)
+
+        with self.make_executor(self.workers) as executor:
+            results = run_pipeline(jobs, transform, self.write_outputs,
+                                   self.workers, self.io_threads, read=read)
+            yield from self.progress(results, unit="img")
+
+    def open_event_log(self):
+        if self.event_log and isinstance(self.event_log, str):
+            log_file = open(self.event_log, "a", encoding="utf-8")
+            self.events = EventLog(log_file, self.event_rate)
+            return log_file
+        self.events = EventLog(self.event_log, self.event_rate)
+        return None
+
+    def find_images(self, streaming=False):
+        # With --shard, only the files this node owns; every node walks the same tree.
+        image_files = iter_images(self.input_dir, IMAGE_EXTENSIONS) if streaming else self.collect_images()
+        if self.shard:
+            image_files = self.shard.select(image_files, self.input_dir)
+        return image_files
+
+    def manifest_name(self):
+        # Shards sharing an output directory keep separate SQLite manifests, so neither
+        # concurrent writers nor one shard's prune touch another shard's entries.
+        from manifest import MANIFEST_NAME
+        if self.shard:
+            return f".sit-manifest-{self.shard.index:04d}-of-{self.shard.count:04d}.sqlite"
+        return MANIFEST_NAME
+
+    def process_directory(self):
+        manifest = None
+        states = {}
+        self.metrics = RunMetrics()
+        log_file = self.open_event_log()
+        source_archive = None
+        if is_archive(self.input_dir):
+            from archive import ArchiveSource
+            source_archive = ArchiveSource(self.input_dir)
+        if source_archive and (self.incremental or self.delete_originals):
+            print("Archive inputs are processed in full and never deleted; ignoring incremental and delete_originals.")
+        if self.incremental and not source_archive:
+            from manifest import Manifest
+            manifest = Manifest(self.input_dir, self.output_dir, self.settings_fingerprint(),
+                                self.content_hash, self.manifest_name())
+        if self.shard and (source_archive or self.archive):
+            print("Archive inputs and outputs are not sharded; processing everything.")
+        elif self.shard:
+            from shard import ShardLog
+            self.shard_log = ShardLog(self.output_dir, self.shard, self.input_dir,
+                                      self.settings_fingerprint())
+        if self.archive:
+            from archive import ArchiveWriter
+            self.archive_writer = ArchiveWriter(
+                self.output_dir, self.archive, self.archive_size)
+        self.source_archive = source_archive
+        duplicates = {}
+        completed = False
+        scanned = True
+        if self.dedup and (source_archive or self.archive_writer):
+            print("Dedup is not applied to archive inputs or outputs.")
+        try:
+            # Archive shards are written by this process, so workers only render: the
+            # streaming pipeline is used even without --stream. Archive inputs are always
+            # streamed member by member.
+            if source_archive:
+                results = self.run_streaming(source_archive.iter_jobs(
+                    self.output_dir, IMAGE_EXTENSIONS), source_archive)
+            elif self.streaming or self.archive_writer:
+                jobs = self.iter_jobs(self.find_images(streaming=True), manifest, states)
+                if self.dedup and not self.archive_writer:
+                    jobs, duplicates = self.dedup_jobs(list(jobs))
+                results = self.run_streaming(jobs)
+            else:
+                jobs = list(self.iter_jobs(self.find_images(), manifest, states))
+                if self.dedup:
+                    jobs, duplicates = self.dedup_jobs(jobs)
+                results = self.run_jobs(jobs)
+            for file_path, output_paths, error, stats in results:
+                self.report_result(file_path, output_paths, error, stats)
+                if file_path == SCAN_FAILED:
+                    scanned = False
+                if manifest and not error and file_path in states:
+                    manifest.record(file_path, states.pop(file_path), output_paths)
+                if duplicates:
+                    self.report_duplicates(file_path, output_paths, error, stats,
+                                           duplicates, manifest, states)
+            # A failed walk ends the stream early, so the sources it did not reach were
+            # never checked and must not be pruned.
+            completed = scanned
+        finally:
+            if source_archive:
+                source_archive.close()
+                self.source_archive = None
+            if self.archive_writer:
+                self.archive_writer.close()
+                print(self.archive_writer.summary())
+                self.archive_writer = None
+            self.metrics.finish()
+            self.events.close()
+            if log_file:
+                log_file.close()
+            if manifest:
+                # An interrupted run has not seen every source; pruning then would drop
+                # entries for files that are still current.
+                if completed:
+                    manifest.prune()
+                manifest.close()
+                print(manifest.summary())
+            if self.shard_log:
+                self.shard_log.close(done=completed)
+                print(f"Shard {self.shard}: {self.shard_log.processed} processed, "
+                      f"{self.shard_log.unchanged} unchanged, {self.shard_log.failed} failed; "
+                      f"manifest {self.shard_log.path}")
+                self.shard_log = None
+            print(self.metrics.summary())
+            if self.metrics_path:
+                self.metrics.export(self.metrics_path)
+
+    def watch_directory(self, settle=0.5, poll_interval=None, stop=None):
+        # Keeps this optimizer and its worker pool alive and processes files as they arrive.
+        # Existing files are queued on startup (skipped by --incremental when unchanged).
+        stop = stop or threading.Event()
+        previous = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous[signum] = signal.signal(
+                    signum, lambda *_: stop.set())
+        self.metrics = RunMetrics()
+        log_file = self.open_event_log()
+        manifest = None
+        if self.incremental:
+            from manifest import Manifest
+            manifest = Manifest(self.input_dir, self.output_dir,
+                                self.settings_fingerprint(), self.content_hash)
+        from concurrent.futures import wait
+        from watcher import SettleTracker, make_watcher
+        input_dir = self.input_dir
+        watcher = make_watcher(input_dir, IMAGE_EXTENSIONS,
+                               self.output_dir, poll_interval)
+        tracker = SettleTracker(settle)
+        for file_path, _ in iter_images(input_dir, IMAGE_EXTENSIONS):
+            tracker.touch(file_path)
+        executor = self.make_executor(self.workers) if self.workers > 1 else None
+        budget = MemoryBudget(self.max_memory) if executor and self.max_memory else None
+        in_flight = {}
+        finished = []
+        print(f"Watching {self.input_dir} (Ctrl+C or SIGTERM to stop)")
+
+        def finish(file_path, output_paths, error, stats, state):
+            finished.append(file_path)
+            self.report_result(file_path, output_paths, error, stats)
+            if manifest and not error:
+                manifest.record(file_path, state, output_paths)
+
+        try:
+            while not stop.is_set():
+                for file_path in watcher.poll(min(0.1, settle)):
+                    tracker.touch(file_path)
+                for file_path in tracker.ready(in_flight):
+                    state = None
+                    if manifest:
+                        try:
+                            fresh, state = manifest.check(file_path)
+                        except OSError:
+                            continue
+                        if fresh:
+                            continue
+                    output_dir_for_file = os.path.normpath(os.path.join(
+                        self.output_dir, os.path.relpath(os.path.dirname(file_path), input_dir)))
+                    if executor is None:
+                        stats = FileStats()
+                        try:
+                            finish(file_path, self._process_image(
+                                file_path, output_dir_for_file, stats), None, stats, state)
+                        except Exception as e:
+                            stats.error_class = type(e).__name__
+                            finish(file_path, [], e, stats, state)
+                        continue
+                    cost = 0
+                    if budget:
+                        try:
+                            cost = self.estimate_memory(file_path)
+                        except Exception as e:
+                            finish(file_path, [], e, None, state)
+                            continue
+                        if not budget.acquire(cost, timeout=0):
+                            tracker.touch(file_path)
+                            continue
+                    future = executor.submit(
+                        _process_in_worker, (file_path, output_dir_for_file))
+                    if budget:
+                        future.add_done_callback(
+                            lambda _, cost=cost: budget.release(cost))
+                    in_flight[file_path] = (future, state)
+                for file_path in [p for p, (f, _) in in_flight.items() if f.done()]:
+                    future, state = in_flight.pop(file_path)
+                    finish(*future.result(), state)
+                if finished:
+                    finished.clear()
+                    if manifest:
+                        manifest.commit()
+                    if self.metrics_path:
+                        self.metrics.finish()
+                        self.metrics.export(self.metrics_path)
+        finally:
+            # In-flight files are finished so their outputs and manifest entries are complete.
+            if in_flight:
+                wait([f for f, _ in in_flight.values()])
+                for file_path, (future, state) in in_flight.items():
+                    finish(*future.result(), state)
+            if executor:
+                executor.shutdown()
+            watcher.close()
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            self.metrics.finish()
+            self.events.close()
+            if log_file:
+                log_file.close()
+            if manifest:
+                manifest.close()
+                print(manifest.summary())
+            print(self.metrics.summary())
+            if self.metrics_path:
+                self.metrics.export(self.metrics_path)
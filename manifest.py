@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+MANIFEST_NAME = ".sit-manifest.sqlite"
+COMMIT_EVERY = 100
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def settings_digest(settings):
+    encoded = json.dumps(settings, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=20).hexdigest()
+
+
+class Manifest:
+    def __init__(self, input_dir, output_dir, settings, content_hash=False, name=MANIFEST_NAME):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.content_hash = content_hash
+        self.settings_hash = settings_digest(settings)
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self.seen = set()
+        self._pending = 0
+        os.makedirs(output_dir, exist_ok=True)
+        self.path = os.path.join(output_dir, name)
+        # Streaming runs check entries from the scanner thread and record them from the main thread.
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "source TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "digest TEXT, settings TEXT, outputs TEXT)")
+
+    def _key(self, file_path):
+        return os.path.relpath(file_path, self.input_dir).replace(os.sep, "/")
+
+    def _output_state(self, output_path):
+        st = os.stat(output_path)
+        return [os.path.relpath(output_path, self.output_dir).replace(os.sep, "/"), st.st_size, st.st_mtime_ns]
+
+    def _outputs_intact(self, outputs):
+        for relative_path, size, mtime_ns in outputs:
+            try:
+                st = os.stat(os.path.join(self.output_dir, relative_path))
+            except OSError:
+                return False
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                return False
+        return True
+
+    def check(self, file_path):
+        with self.lock:
+            return self._check(file_path)
+
+    def _check(self, file_path):
+        key = self._key(file_path)
+        self.seen.add(key)
+        st = os.stat(file_path)
+        state = {"key": key, "size": st.st_size,
+                 "mtime_ns": st.st_mtime_ns, "digest": None}
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, digest, settings, outputs FROM entries WHERE source = ?", (key,)).fetchone()
+        fresh = False
+        if row is not None:
+            size, mtime_ns, digest, settings, outputs = row
+            if settings == self.settings_hash and size == st.st_size and self._outputs_intact(json.loads(outputs)):
+                if mtime_ns == st.st_mtime_ns:
+                    fresh = True
+                elif self.content_hash and digest:
+                    state["digest"] = file_digest(file_path)
+                    if state["digest"] == digest:
+                        fresh = True
+                        self.conn.execute(
+                            "UPDATE entries SET mtime_ns = ? WHERE source = ?", (st.st_mtime_ns, key))
+                        self._tick()
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return fresh, state
+
+    def record(self, file_path, state, output_paths):
+        with self.lock:
+            self._record(file_path, state, output_paths)
+
+    def _record(self, file_path, state, output_paths):
+        digest = state["digest"]
+        if self.content_hash and digest is None and os.path.exists(file_path):
+            digest = file_digest(file_path)
+        outputs = [self._output_state(p) for p in output_paths]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries (source, size, mtime_ns, digest, settings, outputs) VALUES (?, ?, ?, ?, ?, ?)",
+            (state["key"], state["size"], state["mtime_ns"], digest, self.settings_hash, json.dumps(outputs)))
+        self._tick()
+
+    def _tick(self):
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self.conn.commit()
+            self._pending = 0
+
+    def commit(self):
+        with self.lock:
+            if self._pending:
+                self.conn.commit()
+                self._pending = 0
+
+    def prune(self):
+        with self.lock:
+            return self._prune()
+
+    def _prune(self):
+        stale = [key for (key,) in self.conn.execute(
+            "SELECT source FROM entries") if key not in self.seen]
+        self.conn.executemany(
+            "DELETE FROM entries WHERE source = ?", [(key,) for key in stale])
+        self.pruned += len(stale)
+        return len(stale)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def summary(self):
+        return f"Incremental: {self.hits} unchanged (skipped), {self.misses} processed, {self.pruned} stale entries pruned"
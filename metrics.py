@@ -0,0 +1,259 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+STAGES = ("decode", "resize", "encode", "write")
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+def classify_error(error, stats=None):
+    if stats and stats.error_class:
+        return stats.error_class
+    if isinstance(error, Exception):
+        return type(error).__name__
+    return "Error"
+
+
+class FileStats:
+    def __init__(self):
+        self.stages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.pixels_in = 0
+        self.pixels_out = 0
+        self.encodes = 0
+        self.target_misses = 0
+        self.passthrough = False
+        self.duplicate_of = None
+        self.seconds_saved = 0.0
+        self.error_class = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def total_seconds(self):
+        return sum(self.stages.values())
+
+
+class Histogram:
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return self.max if bound == float("inf") else min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "max": round(self.max, 6),
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): total
+                        for bound, total in self.cumulative()},
+        }
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {name: Histogram() for name in STAGES}
+        self.file_seconds = Histogram()
+        self.files_ok = 0
+        self.files_failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.pixels_in = 0
+        self.pixels_out = 0
+        self.encodes = 0
+        self.target_misses = 0
+        self.passthrough = 0
+        self.duplicates = 0
+        self.seconds_saved = 0.0
+        self.errors = {}
+        self.started = time.time()
+        self.wall_seconds = 0.0
+
+    def observe(self, output_paths, error=None, stats=None):
+        with self.lock:
+            if error:
+                self.files_failed += 1
+                error_class = classify_error(error, stats)
+                self.errors[error_class] = self.errors.get(
+                    error_class, 0) + 1
+            else:
+                self.files_ok += 1
+            if stats is None:
+                return
+            for name, seconds in stats.stages.items():
+                self.stages.setdefault(name, Histogram()).observe(seconds)
+            self.file_seconds.observe(stats.total_seconds())
+            self.bytes_in += stats.bytes_in
+            self.bytes_out += stats.bytes_out
+            self.pixels_in += stats.pixels_in
+            self.pixels_out += stats.pixels_out
+            self.encodes += stats.encodes
+            self.target_misses += stats.target_misses
+            self.passthrough += int(stats.passthrough)
+            if stats.duplicate_of and not error:
+                self.duplicates += 1
+                self.seconds_saved += stats.seconds_saved
+
+    def finish(self):
+        self.wall_seconds = time.time() - self.started
+
+    def to_dict(self):
+        return {
+            "files": {"ok": self.files_ok, "failed": self.files_failed},
+            "wall_seconds": round(self.wall_seconds, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "pixels_in": self.pixels_in,
+            "pixels_out": self.pixels_out,
+            "encodes": self.encodes,
+            "target_misses": self.target_misses,
+            "passthrough": self.passthrough,
+            "duplicates": self.duplicates,
+            "seconds_saved": round(self.seconds_saved, 3),
+            "errors": dict(self.errors),
+            "file_seconds": self.file_seconds.to_dict(),
+            "stages": {name: hist.to_dict() for name, hist in self.stages.items()},
+        }
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP sit_files_total Files processed, by status.",
+            "# TYPE sit_files_total counter",
+            f'sit_files_total{{status="ok"}} {self.files_ok}',
+            f'sit_files_total{{status="error"}} {self.files_failed}',
+            "# HELP sit_errors_total Failed files, by exception class.",
+            "# TYPE sit_errors_total counter",
+        ]
+        for error_class, count in sorted(self.errors.items()):
+            lines.append(f'sit_errors_total{{class="{error_class}"}} {count}')
+        for name, value, help_text in (
+                ("sit_bytes_in_total", self.bytes_in, "Source bytes read."),
+                ("sit_bytes_out_total", self.bytes_out, "Output bytes written."),
+                ("sit_pixels_in_total", self.pixels_in, "Source pixels decoded."),
+                ("sit_pixels_out_total", self.pixels_out, "Output pixels encoded."),
+                ("sit_encodes_total", self.encodes, "Encoder invocations, including target-size search."),
+                ("sit_target_misses_total", self.target_misses, "Outputs over --target-size even at the lowest quality."),
+                ("sit_passthrough_total", self.passthrough, "Files copied without decoding by --passthrough."),
+                ("sit_duplicates_total", self.duplicates, "Duplicate sources whose outputs were linked by --dedup."),
+                ("sit_seconds_saved_total", round(self.seconds_saved, 6), "Processing seconds avoided by --dedup.")):
+            lines += [f"# HELP {name} {help_text}",
+                      f"# TYPE {name} counter", f"{name} {value}"]
+        lines += ["# HELP sit_run_seconds Wall-clock duration of the run.",
+                  "# TYPE sit_run_seconds gauge", f"sit_run_seconds {self.wall_seconds:.6f}",
+                  "# HELP sit_stage_seconds Time spent per file in each pipeline stage.",
+                  "# TYPE sit_stage_seconds histogram"]
+        for name, hist in self.stages.items():
+            for bound, total in hist.cumulative():
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(
+                    f'sit_stage_seconds_bucket{{stage="{name}",le="{le}"}} {total}')
+            lines.append(
+                f'sit_stage_seconds_sum{{stage="{name}"}} {hist.sum:.6f}')
+            lines.append(
+                f'sit_stage_seconds_count{{stage="{name}"}} {hist.count}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self):
+        seconds = self.wall_seconds or 1e-9
+        summary = (f"Processed {self.files_ok} files ({self.files_failed} failed) in {self.wall_seconds:.1f}s, "
+                   f"{self.files_ok / seconds:.1f} img/s, {self.bytes_in} -> {self.bytes_out} bytes")
+        if self.passthrough:
+            summary += f", {self.passthrough} passed through unchanged"
+        if self.duplicates:
+            summary += f", {self.duplicates} duplicates linked ({self.seconds_saved:.1f}s of processing avoided)"
+        return summary
+
+
+class EventLog:
+    def __init__(self, stream=None, rate=50):
+        self.stream = stream or sys.stdout
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def _allow(self):
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self.tokens = min(float(self.rate), self.tokens +
+                          (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def _write(self, record):
+        self.stream.write(json.dumps(record, default=str) + "\n")
+
+    def emit(self, event, force=False, **fields):
+        # Errors are passed with force=True and are never dropped; other events are
+        # limited to `rate` per second and the number dropped is reported.
+        with self.lock:
+            if not self._allow() and not force:
+                self.suppressed += 1
+                return
+            if self.suppressed:
+                self._write({"ts": round(time.time(), 3),
+                             "event": "suppressed", "count": self.suppressed})
+                self.suppressed = 0
+            self._write({"ts": round(time.time(), 3), "event": event, **fields})
+
+    def close(self):
+        with self.lock:
+            if self.suppressed:
+                self._write({"ts": round(time.time(), 3),
+                             "event": "suppressed", "count": self.suppressed})
+                self.suppressed = 0
+            self.stream.flush()
@@ -0,0 +1,211 @@
+import os
+import queue
+import shutil
+import threading
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz",
+                      ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# Reported as the file of the error that ended the job iterator.
+SCAN_FAILED = "<scan>"
+
+_DONE = object()
+
+
+def is_archive(path):
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def iter_images(input_dir, extensions):
+    if os.path.isfile(input_dir):
+        if input_dir.lower().endswith(extensions):
+            yield input_dir, "."
+        return
+    stack = [input_dir]
+    while stack:
+        directory = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(extensions):
+                        yield entry.path, os.path.relpath(directory, input_dir)
+        except OSError as e:
+            print(f"Error scanning {directory}: {e}")
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+class MemoryBudget:
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, cost, timeout=None):
+        # Work larger than the whole budget waits until nothing else is running and then
+        # runs alone, which makes it a single-slot lane.
+        cost = min(cost, self.total)
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.used + cost <= self.total, timeout):
+                return False
+            self.used += cost
+            return True
+
+    def release(self, cost):
+        with self.condition:
+            self.used -= min(cost, self.total)
+            self.condition.notify_all()
+
+
+def read_source(file_path, output_dir_for_file):
+    with open(file_path, "rb") as f:
+        return file_path, output_dir_for_file, f.read()
+
+
+def temp_path(path):
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def same_file(src, dst):
+    try:
+        return os.path.samefile(src, dst)
+    except OSError:
+        return False
+
+
+def write_file(path, data):
+    # Outputs are replaced, never rewritten in place: an existing output may be a hardlink
+    # to a source (--passthrough link) or to another output (--dedup), and truncating it
+    # would change those files too.
+    temp = temp_path(path)
+    try:
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def _copy_to(src, dst):
+    # copy_file_range lets the kernel copy (or reflink) without passing the bytes through
+    # user space; shutil.copyfile falls back to sendfile on Linux.
+    copy_range = getattr(os, "copy_file_range", None)
+    if copy_range:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = copy_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def copy_file(src, dst):
+    # Copied to a temporary name and moved into place, for the same reason as write_file.
+    if same_file(src, dst):
+        return
+    temp = temp_path(dst)
+    try:
+        _copy_to(src, temp)
+        os.replace(temp, dst)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def link_file(src, dst):
+    if same_file(src, dst):
+        return
+    temp = temp_path(dst)
+    try:
+        os.link(src, temp)
+        os.replace(temp, dst)
+    except OSError:
+        if os.path.lexists(temp):
+            os.remove(temp)
+        copy_file(src, dst)
+
+
+def process_pool(max_workers, initializer, initargs):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    # Workers are started on demand while pipeline threads may hold locks, so they are
+    # forked from a clean fork server instead of from this process where possible.
+    context = None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                               initializer=initializer, initargs=initargs)
+
+
+def _start_stage(fn, in_queue, out_queue, done_queue, threads, downstream):
+    remaining = [threads]
+    lock = threading.Lock()
+
+    def loop():
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            try:
+                result = fn(*item)
+            except Exception as e:
+                done_queue.put((item[0], [], e, None))
+                continue
+            out_queue.put(result)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(downstream):
+                out_queue.put(_DONE)
+
+    for _ in range(threads):
+        threading.Thread(target=loop, daemon=True).start()
+
+
+def run_pipeline(jobs, transform, write, workers=1, io_threads=4, queue_size=None, read=read_source):
+    # Every stage runs in its own threads, connected by bounded queues, so memory stays
+    # flat however many jobs the iterator produces. Results arrive in completion order.
+    queue_size = queue_size or 2 * max(workers, io_threads)
+    read_queue = queue.Queue(maxsize=queue_size)
+    transform_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    done_queue = queue.Queue(maxsize=queue_size)
+
+    def scan():
+        try:
+            for job in jobs:
+                read_queue.put(job)
+        except Exception as e:
+            done_queue.put((SCAN_FAILED, [], e, None))
+        finally:
+            for _ in range(io_threads):
+                read_queue.put(_DONE)
+
+    def write_stage(file_path, outputs, stats):
+        return file_path, write(file_path, outputs, stats), None, stats
+
+    _start_stage(read, read_queue, transform_queue,
+                 done_queue, io_threads, workers)
+    _start_stage(transform, transform_queue, write_queue,
+                 done_queue, workers, io_threads)
+    _start_stage(write_stage, write_queue, done_queue,
+                 done_queue, io_threads, 1)
+    threading.Thread(target=scan, daemon=True).start()
+    while True:
+        result = done_queue.get()
+        if result is _DONE:
+            return
+        yield result
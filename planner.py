@@ -0,0 +1,343 @@
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from metrics import FileStats
+from pipeline import process_pool
+
+# Files are stratified by format, megapixel bucket (upper bounds), animation and
+# passthrough, since those drive both the time per file and the output size.
+MEGAPIXEL_BUCKETS = (1, 4, 12, 24, float("inf"))
+SCAN_BATCH = 4096
+FLAG_EXAMPLES = 10
+FLAG_REASONS = {
+    "unreadable": "cannot be identified from their header",
+    "too_large": "exceed Pillow's decompression bomb limit",
+    "crop_pixels": "have crop_pixels larger than the output",
+    "over_memory": "exceed the per-worker memory limit",
+    "sample_error": "failed while encoding the sample",
+}
+
+_worker_optimizer = None
+
+
+def megapixel_bucket(pixels):
+    for bound in MEGAPIXEL_BUCKETS:
+        if pixels < bound * 1e6:
+            return bound
+
+
+def physical_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def format_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1000:
+            return f"{value:.1f} {unit}" if unit != "B" else f"{value} B"
+        value /= 1000
+    return f"{value:.1f} TB"
+
+
+def format_seconds(seconds):
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m"
+
+
+class WebPHeader:
+    # Just enough of an Image for the geometry, memory and passthrough checks. Pillow's WebP
+    # plugin reads and parses the whole file on open, which made WebP ~40x slower to scan
+    # than JPEG; the RIFF header has the canvas size in its first 30 bytes.
+    format = "WEBP"
+
+    def __init__(self, width, height, mode, animated, exif):
+        self.width, self.height = width, height
+        self.size = (width, height)
+        self.mode = mode
+        self.is_animated = animated
+        self.info = {"exif": b""} if exif else {}
+
+    def draft(self, mode, size):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def open_webp_header(path):
+    with open(path, "rb") as f:
+        head = f.read(30)
+    if len(head) < 30 or head[:4] != b"RIFF" or head[8:12] != b"WEBP":
+        return None
+    chunk = head[12:16]
+    if chunk == b"VP8X":
+        flags = head[20]
+        return WebPHeader(1 + int.from_bytes(head[24:27], "little"),
+                          1 + int.from_bytes(head[27:30], "little"),
+                          "RGBA" if flags & 0x10 else "RGB", bool(flags & 0x02), bool(flags & 0x08))
+    if chunk == b"VP8L" and head[20] == 0x2F:
+        bits = int.from_bytes(head[21:25], "little")
+        return WebPHeader((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1,
+                          "RGBA" if bits >> 28 & 1 else "RGB", False, False)
+    if chunk == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":
+        return WebPHeader(int.from_bytes(head[26:28], "little") & 0x3FFF,
+                          int.from_bytes(head[28:30], "little") & 0x3FFF, "RGB", False, False)
+    return None
+
+
+def open_header(path):
+    if path.lower().endswith(".webp"):
+        header = open_webp_header(path)
+        # The frame count of an animation is not in the header; those go to Pillow.
+        if header is not None and not header.is_animated:
+            return header
+    return Image.open(path)
+
+
+def inspect_image(optimizer, path):
+    # Header only: nothing here decodes pixels. Returns a record, or (reason, path, detail)
+    # for a file that would fail.
+    try:
+        size = os.path.getsize(path)
+        with open_header(path) as img:
+            # Animations are rendered frame by frame, so their pixels count once per frame.
+            frames = getattr(img, "n_frames", 1)
+            record = {"file": path, "bytes": size, "format": img.format, "mode": img.mode,
+                      "animated": frames > 1, "pixels_in": img.width * img.height * frames}
+            try:
+                placed = [optimizer.plan.place(img.width, img.height, target)
+                          for target in optimizer.targets]
+            except ValueError as e:
+                return "crop_pixels", path, f"{img.width}x{img.height}: {e}"
+            record["pixels_out"] = sum(w * h for _, (w, h) in placed) * frames
+            record["passthrough"] = bool(
+                optimizer.passthrough and optimizer.can_pass_through(img, size))
+            record["memory"] = optimizer.image_memory(img)
+        return record
+    except Image.DecompressionBombError as e:
+        return "too_large", path, str(e)
+    except Exception as e:
+        return "unreadable", path, f"{type(e).__name__}: {e}"
+
+
+def _init_planner_worker(optimizer):
+    global _worker_optimizer
+    _worker_optimizer = optimizer
+
+
+def _inspect_batch(paths):
+    return [inspect_image(_worker_optimizer, path) for path in paths]
+
+
+class Stratum:
+    def __init__(self, sample_size, rng):
+        self.files = 0
+        self.bytes_in = 0
+        self.pixels_in = 0
+        self.pixels_out = 0
+        self.sample_size = sample_size
+        self.rng = rng
+        self.reservoir = []
+        self.measured = []
+
+    def add(self, record):
+        self.files += 1
+        self.bytes_in += record["bytes"]
+        self.pixels_in += record["pixels_in"]
+        self.pixels_out += record["pixels_out"]
+        # Reservoir sampling keeps a uniform sample without holding every record.
+        if len(self.reservoir) < self.sample_size:
+            self.reservoir.append(record)
+        else:
+            slot = self.rng.randrange(self.files)
+            if slot < self.sample_size:
+                self.reservoir[slot] = record
+
+    def predict(self):
+        # Ratio estimators: seconds scale with input pixels (decode and resample), bytes with
+        # output pixels. Passthrough strata copy bytes, so they scale with input bytes.
+        seconds = sum(m["seconds"] for m in self.measured)
+        bytes_out = sum(m["bytes_out"] for m in self.measured)
+        pixels_in = sum(m["pixels_in"] for m in self.measured)
+        pixels_out = sum(m["pixels_out"] for m in self.measured)
+        sampled_bytes = sum(m["bytes"] for m in self.measured)
+        if not self.measured:
+            return 0.0, 0
+        predicted_seconds = seconds / pixels_in * self.pixels_in if pixels_in else \
+            seconds / len(self.measured) * self.files
+        if pixels_out:
+            predicted_bytes = bytes_out / pixels_out * self.pixels_out
+        else:
+            predicted_bytes = bytes_out / max(1, sampled_bytes) * self.bytes_in
+        return predicted_seconds, int(predicted_bytes)
+
+
+class RunPlanner:
+    def __init__(self, optimizer, sample=24, seed=0):
+        self.optimizer = optimizer
+        self.sample = max(1, sample)
+        self.rng = random.Random(seed)
+        self.strata = {}
+        self.flags = {reason: [] for reason in FLAG_REASONS}
+        self.flag_counts = {reason: 0 for reason in FLAG_REASONS}
+        workers = optimizer.workers
+        ram = physical_memory()
+        self.memory_limit = optimizer.max_memory or (ram // workers if ram else None)
+        self.scan_seconds = 0.0
+        self.sample_seconds = 0.0
+
+    def flag(self, reason, path, detail=None):
+        self.flag_counts[reason] += 1
+        if len(self.flags[reason]) < FLAG_EXAMPLES:
+            self.flags[reason].append({"file": path, "detail": detail} if detail else {"file": path})
+
+    def make_pool(self):
+        # Header parsing holds the GIL, so with several workers the batches go to processes.
+        if self.optimizer.workers > 1:
+            return process_pool(self.optimizer.workers, _init_planner_worker, (self.optimizer,))
+        _init_planner_worker(self.optimizer)
+        return ThreadPoolExecutor(max_workers=self.optimizer.io_threads)
+
+    def batches(self):
+        paths = (path for path, _ in self.optimizer.find_images(streaming=True))
+        while True:
+            batch = [path for _, path in zip(range(SCAN_BATCH), paths)]
+            if not batch:
+                return
+            yield batch
+
+    def scan(self):
+        start = time.perf_counter()
+        with self.make_pool() as pool:
+            # The walk feeds batches lazily and at most 2 * workers are in flight, so the
+            # scan never holds the whole tree.
+            pending = []
+            for batch in self.batches():
+                pending.append(pool.submit(_inspect_batch, batch))
+                if len(pending) < 2 * max(self.optimizer.workers, 1):
+                    continue
+                self.collect(pending.pop(0).result())
+            for future in pending:
+                self.collect(future.result())
+        self.scan_seconds = time.perf_counter() - start
+
+    def collect(self, results):
+        for result in results:
+            if isinstance(result, tuple):
+                self.flag(*result)
+                continue
+            if self.memory_limit and result["memory"] > self.memory_limit:
+                self.flag("over_memory", result["file"],
+                          f"~{format_bytes(result['memory'])} estimated")
+            key = (result["format"], megapixel_bucket(result["pixels_in"]),
+                   result["animated"], result["passthrough"])
+            if key not in self.strata:
+                self.strata[key] = Stratum(self.sample, self.rng)
+            self.strata[key].add(result)
+
+    def allocate(self):
+        # Every stratum gets at least one sample; the rest is split by share of input pixels.
+        total_pixels = sum(s.pixels_in for s in self.strata.values()) or 1
+        return {key: min(len(s.reservoir), max(1, round(self.sample * s.pixels_in / total_pixels)))
+                for key, s in self.strata.items()}
+
+    def measure(self):
+        start = time.perf_counter()
+        optimizer = self.optimizer
+        output_dir = optimizer.output_dir or "."
+        for key, count in self.allocate().items():
+            stratum = self.strata[key]
+            for record in self.rng.sample(stratum.reservoir, count):
+                stats = FileStats()
+                stats.bytes_in = record["bytes"]
+                began = time.perf_counter()
+                try:
+                    outputs = optimizer.render(record["file"], record["file"], output_dir, stats)
+                except Exception as e:
+                    self.flag("sample_error", record["file"], f"{type(e).__name__}: {e}")
+                    continue
+                stratum.measured.append({
+                    "bytes": record["bytes"], "pixels_in": record["pixels_in"],
+                    "pixels_out": record["pixels_out"], "seconds": time.perf_counter() - began,
+                    "bytes_out": sum(record["bytes"] if data is None else len(data)
+                                     for _, data in outputs)})
+        self.sample_seconds = time.perf_counter() - start
+
+    def run(self):
+        self.scan()
+        self.measure()
+        return self.report()
+
+    def report(self):
+        strata = []
+        cpu_seconds = 0.0
+        bytes_out = 0
+        for (fmt, bucket, animated, passthrough), stratum in sorted(
+                self.strata.items(), key=lambda item: -item[1].pixels_in):
+            seconds, predicted_bytes = stratum.predict()
+            cpu_seconds += seconds
+            bytes_out += predicted_bytes
+            strata.append({"format": fmt, "megapixels_below": bucket if bucket != float("inf") else None,
+                           "animated": animated, "passthrough": passthrough,
+                           "files": stratum.files,
+                           "bytes_in": stratum.bytes_in, "megapixels_in": round(stratum.pixels_in / 1e6, 1),
+                           "sampled": len(stratum.measured), "predicted_seconds": round(seconds, 2),
+                           "predicted_bytes_out": predicted_bytes})
+        # Workers beyond the CPU count add no throughput.
+        parallel = max(1, min(self.optimizer.workers, os.cpu_count() or 1))
+        return {
+            "files": sum(s.files for s in self.strata.values()),
+            "bytes_in": sum(s.bytes_in for s in self.strata.values()),
+            "megapixels_in": round(sum(s.pixels_in for s in self.strata.values()) / 1e6, 1),
+            "workers": self.optimizer.workers,
+            "predicted_cpu_seconds": round(cpu_seconds, 1),
+            "predicted_wall_seconds": round(cpu_seconds / parallel, 1),
+            "predicted_bytes_out": bytes_out,
+            "memory_limit": self.memory_limit,
+            "scan_seconds": round(self.scan_seconds, 2),
+            "sample_seconds": round(self.sample_seconds, 2),
+            "strata": strata,
+            "flags": {reason: {"count": self.flag_counts[reason], "examples": self.flags[reason]}
+                      for reason in FLAG_REASONS if self.flag_counts[reason]},
+        }
+
+
+def print_report(report):
+    print(f"Plan: {report['files']} files, {format_bytes(report['bytes_in'])}, "
+          f"{report['megapixels_in']} MP (headers scanned in {report['scan_seconds']:.1f}s, "
+          f"sample encoded in {report['sample_seconds']:.1f}s)")
+    for stratum in report["strata"]:
+        bucket = f"<{stratum['megapixels_below']} MP" if stratum["megapixels_below"] else ">=24 MP"
+        label = f"{stratum['format']} {bucket}" + (" animated" if stratum["animated"] else "") + \
+            (" passthrough" if stratum["passthrough"] else "")
+        print(f"  {label:<28} {stratum['files']:>8} files  sampled {stratum['sampled']:>3}  "
+              f"~{format_seconds(stratum['predicted_seconds'])} CPU  "
+              f"~{format_bytes(stratum['predicted_bytes_out'])} out")
+    print(f"Predicted: ~{format_bytes(report['predicted_bytes_out'])} output in "
+          f"~{format_seconds(report['predicted_wall_seconds'])} with {report['workers']} worker(s) "
+          f"({format_seconds(report['predicted_cpu_seconds'])} CPU)")
+    for reason, flagged in report["flags"].items():
+        print(f"Flagged: {flagged['count']} files {FLAG_REASONS[reason]}")
+        for example in flagged["examples"]:
+            detail = f" ({example['detail']})" if example.get("detail") else ""
+            print(f"  {example['file']}{detail}")
+
+
+def write_report(report, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
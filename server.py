@@ -0,0 +1,321 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from metrics import Histogram
+from service import get_optimizer
+
+CONTENT_TYPES = {"webp": "image/webp", "jpg": "image/jpeg", "png": "image/png"}
+MAX_EDGE = 4080
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float("inf"))
+
+
+class MemoryCache:
+    # LRU bounded by the total size of the cached bytes rather than the entry count.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.used -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.used += len(data)
+            while self.used > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.used -= len(evicted)
+
+
+class DiskCache:
+    # Files named by key under two-level fan-out directories. Reads bump the mtime so
+    # eviction (oldest mtime first, down to 90% of the limit) approximates LRU.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.used = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime_ns
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.used += len(data)
+            if self.used > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.used = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if self.used <= target:
+                break
+            try:
+                os.remove(path)
+                self.used -= size
+            except OSError:
+                pass
+
+
+class SingleFlight:
+    # Concurrent callers with the same key share one computation.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event()}
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"], True
+        try:
+            call["result"] = fn()
+            return call["result"], False
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+
+
+class RenditionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, cache_dir=None, memory_bytes=256 << 20, disk_bytes=2 << 30,
+                 settings=None, max_renders=None):
+        super().__init__(address, RenditionHandler)
+        self.root = os.path.realpath(root)
+        self.settings = settings or {}
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(cache_dir, disk_bytes) if cache_dir else None
+        self.flight = SingleFlight()
+        # Renders are capped so that a burst of misses cannot starve cache hits of CPU.
+        self.renders = threading.BoundedSemaphore(max_renders or os.cpu_count() or 1)
+        self.latency = {tier: Histogram(LATENCY_BUCKETS)
+                        for tier in ("memory", "disk", "render", "coalesced")}
+        self.latency_lock = threading.Lock()
+
+    def resolve(self, relative_path):
+        path = os.path.realpath(os.path.join(self.root, relative_path))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def observe(self, tier, seconds):
+        with self.latency_lock:
+            self.latency[tier].observe(seconds)
+
+    def render(self, path, params):
+        settings = dict(self.settings)
+        settings.update(params_to_settings(params))
+        with open(path, "rb") as f:
+            data = f.read()
+        with self.renders:
+            outputs = get_optimizer(settings).process_bytes(data)
+        return outputs[params["fmt"]]
+
+    def to_prometheus(self):
+        lines = ["# HELP sit_http_request_seconds Request latency by cache tier.",
+                 "# TYPE sit_http_request_seconds histogram"]
+        with self.latency_lock:
+            for tier, hist in self.latency.items():
+                for bound, total in hist.cumulative():
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(
+                        f'sit_http_request_seconds_bucket{{tier="{tier}",le="{le}"}} {total}')
+                lines.append(
+                    f'sit_http_request_seconds_sum{{tier="{tier}"}} {hist.sum:.6f}')
+                lines.append(
+                    f'sit_http_request_seconds_count{{tier="{tier}"}} {hist.count}')
+        lines += ["# HELP sit_http_cache_bytes Bytes held by each cache tier.",
+                  "# TYPE sit_http_cache_bytes gauge",
+                  f'sit_http_cache_bytes{{tier="memory"}} {self.memory.used}']
+        if self.disk:
+            lines.append(f'sit_http_cache_bytes{{tier="disk"}} {self.disk.used}')
+        return "\n".join(lines) + "\n"
+
+
+def normalize_params(query):
+    # Returns the canonical parameter dict used for both rendering and the cache key, or
+    # an error message.
+    values = {k: v[-1] for k, v in parse_qs(query).items()}
+    params = {"fmt": values.get("fmt", "webp").lower()}
+    if params["fmt"] == "jpeg":
+        params["fmt"] = "jpg"
+    if params["fmt"] not in CONTENT_TYPES:
+        return None, f"fmt must be one of {', '.join(CONTENT_TYPES)}"
+    try:
+        for name in ("w", "h"):
+            if values.get(name):
+                params[name] = int(values[name])
+                if not 0 < params[name] <= MAX_EDGE:
+                    return None, f"{name} must be between 1 and {MAX_EDGE}"
+        params["q"] = int(values.get("q", 80))
+    except ValueError:
+        return None, "w, h and q must be integers"
+    if not 1 <= params["q"] <= 100:
+        return None, "q must be between 1 and 100"
+    params["fit"] = values.get("fit", "contain")
+    if params["fit"] not in ("contain", "cover"):
+        return None, "fit must be contain or cover"
+    if params["fit"] == "cover" and not ("w" in params and "h" in params):
+        params["fit"] = "contain"
+    return params, None
+
+
+def params_to_settings(params):
+    settings = {"output_format": params["fmt"], "quality": params["q"]}
+    w, h = params.get("w"), params.get("h")
+    if params["fit"] == "cover":
+        settings.update(size=(w, h), aspect_ratio=f"{w}:{h}", crop_position="center")
+    elif w or h:
+        settings["max_size"] = (w or MAX_EDGE * 16, h or MAX_EDGE * 16)
+    return settings
+
+
+def cache_key(path, st, params):
+    raw = f"{path}|{st.st_mtime_ns}|{st.st_size}|{json.dumps(params, sort_keys=True)}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class RenditionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as two writes; with Nagle on, keep-alive clients stall on
+    # delayed ACKs for ~40ms per response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="text/plain; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            return self.send_body(200, self.server.to_prometheus().encode("utf-8"),
+                                  "text/plain; version=0.0.4")
+        if not url.path.startswith("/img/"):
+            return self.send_body(404, b"not found\n")
+        path = self.server.resolve(unquote(url.path[len("/img/"):]))
+        if path is None:
+            return self.send_body(404, b"not found\n")
+        params, error = normalize_params(url.query)
+        if error:
+            return self.send_body(400, (error + "\n").encode("utf-8"))
+        try:
+            st = os.stat(path)
+        except OSError:
+            return self.send_body(404, b"not found\n")
+        key = cache_key(path, st, params)
+        etag = f'"{key}"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        tier = "memory"
+        data = self.server.memory.get(key)
+        if data is None and self.server.disk:
+            data = self.server.disk.get(key)
+            tier = "disk"
+            if data is not None:
+                self.server.memory.put(key, data)
+        if data is None:
+            try:
+                data, shared = self.server.flight.do(
+                    key, lambda: self.render_and_store(key, path, params))
+            except Exception as e:
+                return self.send_body(422, f"cannot render {url.path}: {e}\n".encode("utf-8"))
+            tier = "coalesced" if shared else "render"
+        headers["X-Cache"] = tier
+        self.send_body(200, data, CONTENT_TYPES[params["fmt"]], headers)
+        self.server.observe(tier, time.perf_counter() - start)
+
+    def render_and_store(self, key, path, params):
+        data = self.server.render(path, params)
+        self.server.memory.put(key, data)
+        if self.server.disk:
+            self.server.disk.put(key, data)
+        return data
+
+
+def serve(address, root, **kwargs):
+    server = RenditionServer(address, root, **kwargs)
+    host, port = server.server_address[:2]
+    print(f"Serving renditions of {root} on http://{host}:{port}/img/<path>?w=&h=&fmt=&q=")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from image_optimizer import ImageOptimizer
+from pipeline import process_pool
+
+# Settings dicts can come from request parameters (the --serve endpoint), so the cache is an
+# LRU of fixed size rather than growing with every distinct query.
+MAX_OPTIMIZERS = 64
+
+_optimizers = OrderedDict()
+_optimizers_lock = threading.Lock()
+_worker_settings = None
+
+
+def settings_key(settings):
+    return json.dumps(settings or {}, sort_keys=True, default=str)
+
+
+def get_optimizer(settings=None):
+    # One optimizer per distinct settings dict, so the geometry plan and targets are built
+    # once and the target-size quality history is shared across requests.
+    key = settings_key(settings)
+    with _optimizers_lock:
+        optimizer = _optimizers.get(key)
+        if optimizer is None:
+            optimizer = _optimizers[key] = ImageOptimizer(None, None, **(settings or {}))
+            if len(_optimizers) > MAX_OPTIMIZERS:
+                _optimizers.popitem(last=False)
+        else:
+            _optimizers.move_to_end(key)
+        return optimizer
+
+
+def process_bytes(data, settings=None):
+    return get_optimizer(settings).process_bytes(data)
+
+
+def _init_service_worker(settings):
+    global _worker_settings
+    _worker_settings = settings
+
+
+def _process_bytes_in_worker(data):
+    return process_bytes(data, _worker_settings)
+
+
+class AsyncOptimizer:
+    # Runs process_bytes on a bounded executor. Pillow releases the GIL while decoding,
+    # resampling and encoding, so threads scale; "process" isolates crashes and pure-Python
+    # overhead at the cost of pickling the bytes. At most max_pending requests are queued
+    # or running; further callers wait, which is the backpressure.
+    def __init__(self, settings=None, max_workers=None, executor="thread", max_pending=None):
+        self.settings = settings or {}
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.max_workers
+        self.executor_kind = executor
+        if executor == "process":
+            self.executor = process_pool(self.max_workers, _init_service_worker, (self.settings,))
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="sit")
+        self._slots = None
+        self.pending = 0
+
+    async def process(self, data):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        async with self._slots:
+            self.pending += 1
+            try:
+                loop = asyncio.get_running_loop()
+                if self.executor_kind == "process":
+                    return await loop.run_in_executor(self.executor, _process_bytes_in_worker, data)
+                return await loop.run_in_executor(self.executor, process_bytes, data, self.settings)
+            finally:
+                self.pending -= 1
+
+    def full(self):
+        return self.pending >= self.max_pending
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
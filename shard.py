@@ -0,0 +1,267 @@
+import glob
+import hashlib
+import heapq
+import json
+import os
+import socket
+import time
+import unicodedata
+
+from pipeline import iter_images
+
+MANIFEST_PATTERN = ".sit-shard-*-of-*.jsonl"
+MERGED_NAME = ".sit-shards.jsonl"
+BALANCE_MODES = ("hash", "size")
+MISSING_EXAMPLES = 20
+
+
+def parse_shard(text):
+    # "K/N" with 1 <= K <= N; returns (K, N) or None.
+    index, _, count = (text or "").partition("/")
+    if not (index.isdigit() and count.isdigit()):
+        return None
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        return None
+    return index, count
+
+
+def shard_key(input_dir, file_path):
+    # Relative path with "/" separators in NFC, so nodes with different mount points, path
+    # separators or filesystem normalization (macOS stores NFD) agree on every key.
+    if os.path.isfile(input_dir):
+        key = os.path.basename(file_path)
+    else:
+        key = os.path.relpath(file_path, input_dir).replace(os.sep, "/")
+    return unicodedata.normalize("NFC", key)
+
+
+def hash_bucket(key, count):
+    # hash() is salted per process; a digest gives every node the same answer.
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def size_buckets(sized_keys, count):
+    # Greedy longest-processing-time assignment: largest file first onto the least loaded
+    # shard. Ties are broken by key and shard number, so every node that sees the same tree
+    # computes the same assignment.
+    loads = [(0, bucket) for bucket in range(count)]
+    buckets = {}
+    for size, key in sorted(sized_keys, key=lambda item: (-item[0], item[1])):
+        load, bucket = heapq.heappop(loads)
+        buckets[key] = bucket
+        heapq.heappush(loads, (load + size, bucket))
+    return buckets
+
+
+class Shard:
+    def __init__(self, index, count, balance="hash"):
+        self.index = index
+        self.count = count
+        self.balance = balance
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    def manifest_name(self):
+        return f".sit-shard-{self.index:04d}-of-{self.count:04d}.jsonl"
+
+    def select(self, image_files, input_dir):
+        # Hash sharding filters the walk lazily; size balancing needs every size first.
+        if self.balance == "size":
+            return self.select_by_size(list(image_files), input_dir)
+        return (job for job in image_files
+                if hash_bucket(shard_key(input_dir, job[0]), self.count) == self.index - 1)
+
+    def select_by_size(self, image_files, input_dir):
+        sized = []
+        for file_path, _ in image_files:
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = 0
+            sized.append((size, shard_key(input_dir, file_path)))
+        buckets = size_buckets(sized, self.count)
+        return [job for job in image_files
+                if buckets[shard_key(input_dir, job[0])] == self.index - 1]
+
+
+class ShardLog:
+    # Per-shard completion manifest: a header line, one line per finished file and a
+    # footer once the run ends. Lines are flushed as they are written, so a crashed or
+    # still-running shard leaves every file it finished on record.
+    def __init__(self, output_dir, shard, input_dir, settings):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.input_dir = input_dir
+        self.path = os.path.join(output_dir, shard.manifest_name())
+        self.processed = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.file = open(self.path, "w", encoding="utf-8", buffering=1)
+        self.write({"shard": shard.index, "of": shard.count, "balance": shard.balance,
+                    "settings": settings, "host": socket.gethostname(), "started": time.time()})
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def record(self, file_path, output_paths, error=None):
+        record = {"file": shard_key(self.input_dir, file_path)}
+        if error:
+            self.failed += 1
+            record["error"] = str(error)
+        else:
+            self.processed += 1
+            record["outputs"] = [os.path.relpath(p, self.output_dir).replace(os.sep, "/")
+                                 for p in output_paths]
+        self.write(record)
+
+    def record_unchanged(self, file_path):
+        # Skipped by --incremental: its outputs from an earlier run are still current.
+        self.unchanged += 1
+        self.write({"file": shard_key(self.input_dir, file_path), "unchanged": True})
+
+    def close(self, done=True):
+        # Without the footer, merge reports the shard as unfinished.
+        if done:
+            self.write({"done": True, "finished": time.time(), "processed": self.processed,
+                        "unchanged": self.unchanged, "failed": self.failed})
+        self.file.close()
+
+
+def read_shard_log(path):
+    header, files, footer = None, {}, None
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A shard killed mid-write leaves a partial last line.
+                continue
+            if "shard" in record:
+                header = record
+            elif "done" in record:
+                footer = record
+            elif "file" in record:
+                files[record["file"]] = record
+    return header, files, footer
+
+
+def expected_buckets(input_dir, extensions, count, balance):
+    keys = {}
+    sized = []
+    for file_path, _ in iter_images(input_dir, extensions):
+        key = shard_key(input_dir, file_path)
+        if balance == "size":
+            try:
+                sized.append((os.path.getsize(file_path), key))
+            except OSError:
+                sized.append((0, key))
+        else:
+            keys[key] = hash_bucket(key, count)
+    if balance == "size":
+        keys = size_buckets(sized, count)
+    return keys
+
+
+def merge_shards(input_dir, directories, extensions):
+    # Reads every shard manifest in `directories`, checks that together they cover the
+    # current input tree and writes the combined record to the first directory.
+    paths = sorted({p for d in directories for p in glob.glob(os.path.join(d, MANIFEST_PATTERN))})
+    if not paths:
+        return None
+    shards = {}
+    for path in paths:
+        header, files, footer = read_shard_log(path)
+        if header is None:
+            continue
+        shards[header["shard"]] = {"path": path, "header": header, "files": files,
+                                   "footer": footer}
+    if not shards:
+        return None
+    first = shards[min(shards)]["header"]
+    count, balance = first["of"], first["balance"]
+    expected = expected_buckets(input_dir, extensions, count, balance)
+    covered = {}
+    failed = {}
+    for index, shard in shards.items():
+        for key, record in shard["files"].items():
+            if "error" in record:
+                failed.setdefault(key, (index, record["error"]))
+            else:
+                covered[key] = index
+    missing = [key for key in expected if key not in covered]
+    report = {
+        "input": input_dir, "shards": count, "balance": balance,
+        "files": len(expected), "covered": sum(1 for key in expected if key in covered),
+        "missing": len(missing),
+        "missing_examples": sorted(missing)[:MISSING_EXAMPLES],
+        "failed": {key: {"shard": index, "error": error}
+                   for key, (index, error) in sorted(failed.items()) if key not in covered},
+        "settings_mismatch": sorted(index for index, shard in shards.items()
+                                    if shard["header"]["settings"] != first["settings"]
+                                    or shard["header"]["of"] != count),
+        # Files handled by another shard than the current tree maps them to: the tree
+        # changed between the walks. They still count as covered.
+        "reassigned": sum(1 for key, index in covered.items()
+                          if key in expected and expected[key] != index - 1),
+        "per_shard": [],
+    }
+    remaining = {}
+    for key in missing:
+        remaining[expected[key] + 1] = remaining.get(expected[key] + 1, 0) + 1
+    for index in range(1, count + 1):
+        shard = shards.get(index)
+        status = "missing"
+        if shard:
+            status = "done" if shard["footer"] else "running or crashed"
+        report["per_shard"].append({
+            "shard": index, "status": status,
+            "host": shard["header"].get("host") if shard else None,
+            "files": len(shard["files"]) if shard else 0,
+            "remaining": remaining.get(index, 0),
+            "seconds": round(shard["footer"]["finished"] - shard["header"]["started"], 1)
+            if shard and shard["footer"] else None,
+        })
+    report["stragglers"] = [s["shard"] for s in report["per_shard"]
+                            if s["status"] != "done" or s["remaining"]]
+    report["complete"] = not (missing or report["stragglers"] or report["settings_mismatch"])
+    merged_path = os.path.join(directories[0], MERGED_NAME)
+    with open(merged_path, "w", encoding="utf-8") as f:
+        for key in sorted(covered):
+            record = dict(shards[covered[key]]["files"][key], shard=covered[key])
+            f.write(json.dumps(record) + "\n")
+        f.write(json.dumps({key: report[key] for key in
+                            ("shards", "files", "covered", "missing", "complete")}) + "\n")
+    report["merged"] = merged_path
+    return report
+
+
+def print_merge_report(report):
+    print(f"Shards: {report['covered']}/{report['files']} files covered by {report['shards']} "
+          f"shards ({report['balance']} balance)")
+    for shard in report["per_shard"]:
+        line = f"  {shard['shard']:>4}/{report['shards']}  {shard['status']:<18} {shard['files']:>8} files"
+        if shard["host"]:
+            line += f"  on {shard['host']}"
+        if shard["seconds"] is not None:
+            line += f"  in {shard['seconds']}s"
+        if shard["remaining"]:
+            line += f"  {shard['remaining']} not done"
+        print(line)
+    if report["settings_mismatch"]:
+        print(f"Settings or shard count differ from the first shard in shards: "
+              f"{', '.join(map(str, report['settings_mismatch']))}")
+    if report["reassigned"]:
+        print(f"{report['reassigned']} files were handled by another shard than the current "
+              f"tree assigns them to (the input changed between walks).")
+    for key, failure in list(report["failed"].items())[:MISSING_EXAMPLES]:
+        print(f"  failed in shard {failure['shard']}: {key}: {failure['error']}")
+    for key in report["missing_examples"]:
+        print(f"  missing: {key}")
+    if report["complete"]:
+        print(f"Complete. Merged manifest written to {report['merged']}")
+    else:
+        print(f"Incomplete: {report['missing']} files missing, stragglers: "
+              f"{', '.join(map(str, report['stragglers'])) or 'none'}")
@@ -0,0 +1,176 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from pipeline import iter_images
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def excluded(path, exclude):
+    # Keeps the output tree out of the watch when it lives inside the input tree.
+    return bool(exclude) and (os.path.abspath(path) + os.sep).startswith(exclude + os.sep)
+
+
+class InotifyWatcher:
+    def __init__(self, root, extensions, exclude=None):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.root = root
+        self.extensions = extensions
+        self.exclude = exclude and os.path.abspath(exclude)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.dirs = {}
+        self.backlog = []
+        self.watch_tree(root, initial=True)
+
+    def wanted(self, path):
+        return path.lower().endswith(self.extensions) and not excluded(path, self.exclude)
+
+    def watch_tree(self, directory, initial=False):
+        # Files can land in a new directory before its watch is added, so anything already
+        # inside is reported as changed.
+        for root, dirs, files in os.walk(directory):
+            if excluded(root, self.exclude):
+                dirs[:] = []
+                continue
+            wd = self._add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd >= 0:
+                self.dirs[wd] = root
+            if not initial:
+                self.backlog += [os.path.join(root, f) for f in files
+                                 if self.wanted(os.path.join(root, f))]
+
+    def rescan(self):
+        return [path for path, _ in iter_images(self.root, self.extensions) if self.wanted(path)]
+
+    def poll(self, timeout):
+        changed, self.backlog = self.backlog, []
+        if changed:
+            timeout = 0
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed += self.rescan()
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path)
+            elif self.wanted(path):
+                changed.append(path)
+        changed += self.backlog
+        self.backlog = []
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    def __init__(self, root, extensions, exclude=None, interval=1.0):
+        self.root = root
+        self.extensions = extensions
+        self.exclude = exclude and os.path.abspath(exclude)
+        self.interval = interval
+        self.next_scan = 0.0
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for path, _ in iter_images(self.root, self.extensions):
+            if excluded(path, self.exclude):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            return []
+        self.next_scan = time.monotonic() + self.interval
+        snapshot = self.scan()
+        changed = [path for path, state in snapshot.items()
+                   if self.snapshot.get(path) != state]
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(root, extensions, exclude=None, poll_interval=None):
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(root, extensions, exclude)
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({e}), polling {root} every second instead")
+            poll_interval = 1.0
+    return PollingWatcher(root, extensions, exclude, poll_interval)
+
+
+class SettleTracker:
+    def __init__(self, settle):
+        self.settle = settle
+        self.pending = {}
+
+    def touch(self, path):
+        self.pending[path] = (None, time.monotonic())
+
+    def ready(self, busy=()):
+        # A file is ready once its size and mtime have not changed for `settle` seconds,
+        # which also folds a burst of events for the same file into one job.
+        now = time.monotonic()
+        ready = []
+        for path, (state, since) in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != state:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle and path not in busy:
+                del self.pending[path]
+                ready.append(path)
+        return ready